@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+#
+# Synthetic Civilization 5 replay and map files, and microbenchmarks for
+# civ5replay.py that run on them.
+#
+# Real replays vary too much to compare timings between versions of the
+# parser, so this writes replays and maps of a given size instead: a few
+# civs found their capitals, grow their borders, found more cities and
+# capture or raze each other's cities, as often as the war intensity
+# says. The files are generated from a random seed, so the same options
+# always give the same files.
+#
+# Run with -h to see available options. Every repeat of a benchmark runs
+# its setup and timed part in a fresh worker process. The memory reported
+# is the peak resident set size of that process, which includes the setup
+# and the interpreter itself; the largest of the repeats is shown.
+#
+
+import os
+import sys
+import time
+import random
+import struct
+import shutil
+import tempfile
+import optparse
+import resource
+import multiprocessing
+
+import civ5replay
+
+def pack_int(v):
+    return struct.pack("<i", v)
+
+def pack_string(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return pack_int(len(s)) + s
+
+def neighbours(x, y):
+    """ The six neighbours of a hex tile, see Civ5Replay.neighbours() """
+    xoff = y % 2
+    return [ (x+xoff, y-1), (x+1, y), (x+xoff, y+1), (x-1+xoff, y+1), (x-1, y), (x-1+xoff, y-1) ]
+
+def generate_events(size_id=3, civs=8, turns=300, war=0.5, seed=1):
+    """ Play a random game and return its events as (turn, event type, x, y, civ, text) tuples """
+    rnd = random.Random(seed)
+    w, h = civ5replay.map_sizes[size_id][1:]
+    owner = {}
+    cities = {}
+    events = []
+    names = [ (c[0].en, c[1].en) for c in civ5replay.civs ]
+
+    def own(turn, x, y, civ, city=False, text=""):
+        if 0 <= x < w and 0 <= y < h:
+            owner[(x, y)] = civ
+            events.append((turn, city and 1 or 2, x, y, civ, text))
+
+    def free_tile():
+        while True:
+            x, y = rnd.randrange(w), rnd.randrange(h)
+            if (x, y) not in cities:
+                return x, y
+
+    # capitals, named after the civs' first cities so that the parser
+    # can tell who is who, and a couple of city states
+    for c in range(civs):
+        x, y = free_tile()
+        cities[(x, y)] = [c, names[c % len(names)][1]]
+        own(0, x, y, c, True, "%s is founded." % (cities[(x, y)][1],))
+    for k in range(max(2, civs // 2)):
+        x, y = free_tile()
+        cities[(x, y)] = [-1, "City State %d" % (k,)]
+        own(0, x, y, -1, True, "%s is founded." % (cities[(x, y)][1],))
+
+    towns = 0
+    for turn in range(1, turns):
+        # borders grow
+        for (cx, cy), (civ, name) in cities.items():
+            if rnd.random() < 0.5:
+                nx, ny = rnd.choice(neighbours(cx, cy))
+                for tile in [(nx, ny)] + neighbours(nx, ny)[:rnd.randrange(3)]:
+                    if tile not in cities:
+                        own(turn, tile[0], tile[1], civ)
+        # news
+        if rnd.random() < 0.05 * civs:
+            events.append((turn, 0, -1, -1, rnd.randrange(civs), "Something happened on turn %d." % (turn,)))
+        # new cities, less of them in times of war
+        if rnd.random() < 0.8 - 0.5 * war:
+            x, y = free_tile()
+            towns += 1
+            civ = rnd.randrange(civs)
+            cities[(x, y)] = [civ, "Town %d" % (towns,)]
+            own(turn, x, y, civ, True, "Town %d is founded." % (towns,))
+        # war
+        if rnd.random() < war and civs > 1:
+            (cx, cy) = rnd.choice(cities.keys())
+            civ, name = cities[(cx, cy)]
+            # any civ but the owner, who is -1 for city states
+            if civ < 0:
+                attacker = rnd.randrange(civs)
+            else:
+                attacker = rnd.randrange(civs - 1)
+                if attacker >= civ:
+                    attacker += 1
+            attacker_name = names[attacker % len(names)][0]
+            if rnd.random() < 0.7:
+                events.append((turn, 0, cx, cy, attacker, "%s was captured by the %s!" % (name, attacker_name)))
+                cities[(cx, cy)][0] = attacker
+                new_owner = attacker
+            else:
+                events.append((turn, 0, cx, cy, attacker, "%s was set ablaze by the %s!" % (name, attacker_name)))
+                del cities[(cx, cy)]
+                new_owner = -1
+            own(turn, cx, cy, new_owner)
+            for tile in neighbours(cx, cy):
+                if owner.get(tile) == civ and tile not in cities:
+                    own(turn, tile[0], tile[1], new_owner)
+    events.append((turns-1, 0, -1, -1, 0, "The %s has won a Domination Victory!" % (names[0][0],)))
+    return events
+
+def write_replay(path, size_id=3, civs=8, turns=300, war=0.5, seed=1):
+    """ Write a replay file for a random game, see generate_events(). Returns the number of events. """
+    events = generate_events(size_id, civs, turns, war, seed)
+    f = open(path, "wb")
+    # header, see Civ5Replay.read_header()
+    f.write(pack_int(5) + pack_int(0) + pack_int(4))
+    for s in ("George Washington", "American Empire", "America", "American", "Assets\\Maps\\Pangea.lua"):
+        f.write(pack_string(s))
+    f.write(pack_int(size_id) + pack_int(0) + pack_int(1) + pack_int(0) + pack_int(2))
+    f.write(pack_int(2) + pack_int(1) + pack_int(9))                    # game options
+    f.write(pack_int(3) + pack_int(0) + pack_int(1) + pack_int(2))      # victory types
+    f.write(pack_int(2))                                                # victory type
+    f.write(pack_int(len(events) + 1))
+    f.write(pack_int(0) + pack_int(1))
+    f.write(pack_int(1) + pack_int(7) + pack_int(8))
+    f.write(pack_int(-1))
+    # events, see Civ5Replay.read_event_record()
+    for turn, event_type, x, y, civ, text in events:
+        f.write(struct.pack("<6i", 1, turn, event_type, x, y, civ) + pack_string(text) + pack_int(-1))
+    f.write(pack_int(0) + pack_int(-4000) + pack_int(turns-1) + pack_string("2050 AD"))
+    # histogram, see Civ5Replay.read_histogram()
+    f.write(pack_int(0) + pack_int(12345) + pack_int(civs))
+    for c in range(civs):
+        f.write(pack_int(0) + pack_int(0) + pack_int(turns))
+        f.write("".join([ struct.pack("<4i", t * (c+1), t, c, 7) for t in range(turns) ]))
+    f.close()
+    return len(events)
+
+def write_map(path, size_id=3, seed=1):
+    """ Write a random version 11 map file of a given size, see Civ5Map.load_file() """
+    rnd = random.Random(seed)
+    w, h = civ5replay.map_sizes[size_id][1:]
+    terrains = "\0".join(["TERRAIN_GRASS", "TERRAIN_PLAINS", "TERRAIN_DESERT", "TERRAIN_TUNDRA", "TERRAIN_SNOW", "TERRAIN_COAST", "TERRAIN_OCEAN"]) + "\0"
+    features = "\0".join(["FEATURE_ICE", "FEATURE_JUNGLE", "FEATURE_MARSH", "FEATURE_OASIS", "FEATURE_FLOOD_PLAINS", "FEATURE_FOREST"]) + "\0"
+    resources = "\0".join(["RESOURCE_IRON", "RESOURCE_HORSE", "RESOURCE_COAL"]) + "\0"
+    f = open(path, "wb")
+    f.write(chr(0x0b) + pack_int(w) + pack_int(h) + "\0" + pack_int(0))
+    f.write(pack_int(len(terrains)) + pack_int(len(features)) + pack_int(0) + pack_int(len(resources)))
+    f.write(pack_int(0) + pack_int(len("Benchmark")) + pack_int(0))
+    f.write(terrains + features + resources + "Benchmark" + pack_int(0))
+    for y in range(h):
+        f.write("".join([ struct.pack("8b", rnd.randrange(7), rnd.choice([-1, -1, 0, 1, 2]), rnd.choice([-1, -1, 0, 1, 5]),
+            rnd.randrange(8), rnd.randrange(3), 0, 0, 0) for x in range(w) ]))
+    f.close()
+
+#
+# The benchmarks. Each one sets up what it needs from the fixture and
+# returns the function to time.
+#
+
+def open_replay(fixture, full=True):
+    replay = civ5replay.Civ5Replay(fixture["replay"], context=civ5replay.Civ5Context("auto", False))
+    replay.set_background(civ5replay.Civ5Map(fixture["map"]))
+    if full:
+        replay.read_full()
+    return replay
+
+def bench_map_load(fixture):
+    return lambda: civ5replay.Civ5Map(fixture["map"])
+
+def bench_read_event(fixture):
+    def run():
+        replay = civ5replay.Civ5Replay(fixture["replay"], context=civ5replay.Civ5Context("auto", False))
+        while not replay.read_event().is_last_event():
+            pass
+    return run
+
+def bench_domain_region(fixture):
+    replay = open_replay(fixture)
+    ev = replay.events
+    cities = [ (ev.turn[i], ev.x[i], ev.y[i]) for i in xrange(len(ev)) if ev.event_type[i] == 1 ]
+    samples = cities[::max(1, len(cities) // 200)]
+    def run():
+        for turn, x, y in samples:
+            replay.domain_region(turn, x, y)
+    return run
+
+def bench_html(fixture):
+    replay = open_replay(fixture)
+    return replay.html
+
+def bench_csv(fixture):
+    replay = open_replay(fixture)
+    return replay.csv
+
+benchmarks = [
+    ("map_load", bench_map_load),
+    ("read_event", bench_read_event),
+    ("domain_region", bench_domain_region),
+    ("html", bench_html),
+    ("csv", bench_csv),
+]
+
+def peak_rss():
+    """ Return the peak resident set size of this process in bytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
+def run_benchmark(job):
+    """ Set up a benchmark and run it once. Returns the time taken and the peak memory of the process. """
+    name, fixture = job
+    run = dict(benchmarks)[name](fixture)
+    start = time.time()
+    run()
+    return time.time() - start, peak_rss()
+
+if __name__ == "__main__":
+    op = optparse.OptionParser()
+    op.add_option("-s", "--size", type="int", default=3,
+        help="Map size id, 0 (duel) to 5 (huge) (default: %default)", metavar="SIZE")
+    op.add_option("-c", "--civs", type="int", default=8,
+        help="Number of civs (default: %default)", metavar="CIVS")
+    op.add_option("-t", "--turns", type="int", default=300,
+        help="Number of turns (default: %default)", metavar="TURNS")
+    op.add_option("-w", "--war", type="float", default=0.5,
+        help="War intensity from 0 to 1 (default: %default)", metavar="WAR")
+    op.add_option("--seed", type="int", default=1,
+        help="Random seed (default: %default)", metavar="SEED")
+    op.add_option("-o", "--output",
+        help="Keep the generated files in DIR", metavar="DIR")
+    op.add_option("-g", "--generate", action="store_true",
+        help="Only generate the files, don't run any benchmarks")
+    op.add_option("-b", "--bench",
+        help="Only run the comma separated benchmarks in LIST (%s)" % (", ".join([ b[0] for b in benchmarks ]),), metavar="LIST")
+    op.add_option("-r", "--repeat", type="int", default=3,
+        help="Run each benchmark REPEAT times (default: %default)", metavar="REPEAT")
+    (options, args) = op.parse_args()
+
+    directory = options.output
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="civ5bench")
+    elif not os.path.isdir(directory):
+        os.makedirs(directory)
+    base = os.path.join(directory, "bench_%d_%d_%d_%d_%d" % (options.size, options.civs, options.turns, int(options.war*100), options.seed))
+    fixture = { "replay": base + ".Civ5Replay", "map": base + ".Civ5Map" }
+
+    start = time.time()
+    events = write_replay(fixture["replay"], options.size, options.civs, options.turns, options.war, options.seed)
+    write_map(fixture["map"], options.size, options.seed)
+    print "%s map, %d civs, %d turns, war %.2f: %d events, %d KB replay, %d KB map (%.1fs)" % (
+        civ5replay.map_sizes[options.size][0].en, options.civs, options.turns, options.war, events,
+        os.path.getsize(fixture["replay"]) // 1024, os.path.getsize(fixture["map"]) // 1024, time.time() - start)
+
+    if not options.generate:
+        names = [ b[0] for b in benchmarks ]
+        if options.bench:
+            names = options.bench.split(",")
+            for name in names:
+                if name not in dict(benchmarks):
+                    op.error("unknown benchmark %s" % (name,))
+        print "%-16s %10s %10s %10s" % ("benchmark", "best", "mean", "peak RSS")
+        for name in names:
+            # a fresh process for every repeat, so earlier runs don't hide its peak memory
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            results = pool.map(run_benchmark, [ (name, fixture) ] * options.repeat, 1)
+            pool.close()
+            pool.join()
+            times = [ r[0] for r in results ]
+            peak = max([ r[1] for r in results ])
+            print "%-16s %9.4fs %9.4fs %7.1f MB" % (name, min(times), sum(times) / len(times), peak / 1048576.0)
+
+    if options.output is None:
+        shutil.rmtree(directory)
@@ -32,9 +32,36 @@ import optparse
 import codecs
 import signal
 import re
+import mmap
+import array
+import operator
+import collections
+import bisect
+import StringIO
+import base64
+import hashlib
+import glob
+import tempfile
+import time
+import multiprocessing
+import sqlite3
+import marshal
+import json
+import types
+import threading
+import cgi
+import urlparse
+import BaseHTTPServer
+import SocketServer
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on Windows
 
 # safety belt, comment in if you want a one minute timeout on a
-# web server that runs Linux 
+# web server that runs Linux and starts this script for every request.
+# Better yet, run it with --serve, which keeps a pool of workers around
+# and gives every replay such a timeout of its own.
 # signal.alarm(60)
 
 # don't run in debug mode by default
@@ -52,6 +79,9 @@ class L(object):
         self.__repr__ = self.__str__
     def __str__(self):
         return self.__dict__.get(locale, self.en)
+    def get(self, locale):
+        """ Return the string for a given locale, falling back to English """
+        return self.__dict__.get(locale, self.en)
     def __mod__(self, x):
         return self.s() % x
     def __eq__(self, x):
@@ -62,12 +92,161 @@ class L(object):
 def p(*s):
     """ Helper function replacing print for utf-8 output"""
     if debug:
-      for e in s:
-          if not isinstance(e, unicode):
-              e = unicode(e)
-          sys.stdout.write(e.encode("utf-8"))
-          sys.stdout.write(" ")
-      sys.stdout.write("\n")
+        write_line(s)
+
+def write_line(s):
+    """ Write a list of things to stdout as one line of utf-8 text """
+    for e in s:
+        if not isinstance(e, unicode):
+            e = unicode(e)
+        sys.stdout.write(e.encode("utf-8"))
+        sys.stdout.write(" ")
+    sys.stdout.write("\n")
+
+class Civ5Context(object):
+    """ The locale and debug settings used to read and render a replay. Every reader has its own copy, taken from the module-level settings unless one is given, so replays in different languages can be worked on at the same time. """
+
+    def __init__(self, locale="auto", debug=False, profile=None):
+        self.locale = locale
+        self.debug = debug
+        self.profile = profile
+
+    def s(self, x):
+        """ Return a localized string for this context's locale; anything else is returned as it is """
+        if isinstance(x, L):
+            return x.get(self.locale)
+        return x
+
+    def p(self, *s):
+        """ Like p(), for this context's debug setting """
+        if self.debug:
+            write_line(s)
+
+class Civ5Profile(object):
+    """ Wall time and call counts for the expensive methods of replay and map readers. Readers whose context has a profile get these methods wrapped when they are created; without one nothing is wrapped, so profiling costs nothing when it's off. """
+
+    methods = ("load_file", "read_header", "guess_locale", "read_event", "map_string",
+        "domain_info", "domain_region", "infer_razing", "read_histogram", "prepare_html",
+        "html_event_list", "javascript_event_list", "javascript_turn_to_event", "javascript_keyframes",
+        "javascript_histogram_score", "javascript_background", "write_html", "csv")
+
+    def __init__(self):
+        self.start = time.time()
+        self.calls = collections.defaultdict(int)
+        self.seconds = collections.defaultdict(float)
+        self.merged_peak_memory = None
+
+    def add(self, reader):
+        """ Wrap the profiled methods of a reader """
+        for name in self.methods:
+            method = getattr(reader, name, None)
+            if method is not None:
+                setattr(reader, name, self.timed(name, method))
+
+    def timed(self, name, method):
+        def call(*args, **kwargs):
+            start = time.time()
+            result = method(*args, **kwargs)
+            self.seconds[name] += time.time() - start
+            self.calls[name] += 1
+            if isinstance(result, types.GeneratorType):
+                return self.timed_generator(name, result)
+            return result
+        return call
+
+    def timed_generator(self, name, gen):
+        """ Add the time spent generating each chunk of the HTML sections """
+        while True:
+            start = time.time()
+            try:
+                chunk = next(gen)
+            except StopIteration:
+                self.seconds[name] += time.time() - start
+                return
+            self.seconds[name] += time.time() - start
+            yield chunk
+
+    def peak_memory(self):
+        """ Return the peak resident set size of this process in bytes, or None if it can't be found out """
+        if resource is None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return rss
+        return rss * 1024
+
+    def merge(self, report):
+        """ Add the calls and times of a report() from another process, such as a batch worker. The peak memory reported is then the largest of all of them. """
+        for name, phase in report["phases"].items():
+            self.calls[name] += phase["calls"]
+            self.seconds[name] += phase["seconds"]
+        if report["peak_memory"] is not None:
+            self.merged_peak_memory = max(self.merged_peak_memory, report["peak_memory"])
+
+    def report(self):
+        """ Return the times and call counts as a dictionary. Times of methods include those of the methods they call. """
+        peak_memory = self.peak_memory()
+        if self.merged_peak_memory is not None:
+            peak_memory = max(peak_memory, self.merged_peak_memory)
+        return {
+            "seconds":      time.time() - self.start,
+            "peak_memory":  peak_memory,
+            "phases":       dict((name, {"calls": self.calls[name], "seconds": self.seconds[name]}) for name in self.calls),
+        }
+
+    def write(self, fp):
+        """ Write the report to a file-like object as JSON """
+        json.dump(self.report(), fp, indent=2, sort_keys=True)
+        fp.write("\n")
+
+class TextMatcher(object):
+    """ Finds localized messages in a text with a single regexp scan """
+
+    def __init__(self, messages):
+        # list of (kind, L) pairs, in order of priority
+        self.messages = messages
+        self.priority = dict((kind, i) for i, (kind, l) in enumerate(messages))
+        self.regexps = {}
+
+    def regexp(self, locale):
+        """ Return the compiled regexp for one locale, or for all of them if locale is "auto", and a dictionary mapping each matched text to its (locale, kind) pairs """
+        if locale not in self.regexps:
+            lookup = {}
+            for kind, l in self.messages:
+                if locale == "auto":
+                    items = [ (k, v) for k, v in l.items() if isinstance(v, unicode) ]
+                else:
+                    items = [ (locale, l.__dict__.get(locale, l.en)) ]
+                for k, v in items:
+                    lookup.setdefault(v, []).append((k, kind))
+            # longest first, so the regexp prefers a message over any message it contains
+            texts = sorted(lookup.keys(), key=len, reverse=True)
+            self.regexps[locale] = (re.compile(u"|".join(map(re.escape, texts)), re.U), lookup)
+        return self.regexps[locale]
+
+    def locales(self):
+        """ Return the set of locales any of the messages are translated to """
+        return set(k for kind, l in self.messages for k, v in l.items() if isinstance(v, unicode))
+
+    def find(self, text, locale="auto"):
+        """ Return the (locale, kind) pairs of all messages found in text, the highest priority first """
+        regexp, lookup = self.regexp(locale)
+        found = []
+        for m in regexp.finditer(text):
+            found.extend(lookup[m.group(0)])
+        found.sort(key=lambda x: self.priority[x[1]])
+        return found
+
+    def classify(self, text, locale="auto"):
+        """ Return the (locale, kind) pair of the highest priority message in text, or None """
+        found = self.find(text, locale)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def kinds(self, text, locale):
+        """ Return the set of message kinds found in text for a locale """
+        return set(kind for k, kind in self.find(text, locale))
 
 # difficulty level names TXT_KEY_HANDICAP_* Still need ja and ru
 difficulty_strings = [
@@ -130,6 +309,26 @@ game_options = {
 option_noraze = 0;
 option_occ = 5;
 
+# messages in the event text that tell us what happened, and which
+# language the replay was recorded in
+# TXT_KEY_GAME_WON ja, ru guessed from replays
+victory_message = L(" has won ",fr=" a remporté ",de=" hat den Sieg in der Kategorie ",es=" ha conseguido una ",it=" ha riportato una vittoria ",ko=" 승리를 거두었습니다",pl=" wygrywa przez Zwycięstwo ",ja="勝利を収めた",ru=" одерживает ")
+# TXT_KEY_MISC_CITY_IS_FOUNDED ; ja (が建設されました。/が創設された。) and ru guessed from replays
+founded_message = L(" is founded.",fr=" fondée !",de=" wurde gegründet.",es="Se funda ",it=" è fondata.",ko="이(가) 건설되었습니다.",pl="Powstaje ",ja="設され",ru="Основан город")
+# TXT_KEY_MISC_CITY_RAZED_BY ja, ru guessed from replays
+razed_message = L(" was set ablaze by ",fr=" incendié ",de=" in Brand gesteckt",es=" ha sido arrasada por el ",it=" è stata messa a ferro e fuoco dall",ko="(으)로 인해 불바다가 되었습니다",pl=" podpala ",ru=" огню город ")
+# TXT_KEY_MISC_CITY_WAS_CAPTURED_BY ja, ru guessed from replays
+captured_message = L(" was captured by ",fr=" pris ",de=" eingenommen",es=" ha capturado ",it=" è stata catturata dall",ko="에 점령당했습니다",pl=" zdobywa ",ja="に占領されました",ru=" захвачен державой ")
+
+# One regexp per locale that finds all of the above in a single scan.
+# The order is the order in which they're used to guess the locale.
+event_messages = TextMatcher([
+    ("founded",  founded_message),
+    ("captured", captured_message),
+    ("razed",    razed_message),
+    ("victory",  victory_message),
+])
+
 # the colour to use for city state owned tiles
 citystate_color = ["#dddddd", "black"]
 
@@ -368,6 +567,7 @@ span.%(id)s_disabled_option {
         &nbsp;&nbsp;&nbsp;&nbsp;
         
         <a class="%(id)s_button" onclick="%(id)s_toggle_alpha()" onselectstart="return false">&#945;</a>
+        <a class="%(id)s_button" id="%(id)s_speed" onclick="%(id)s_toggle_speed()" onselectstart="return false">%(turns_per_second)d/s</a>
        
         &nbsp;&nbsp;&nbsp;&nbsp;
         &nbsp;&nbsp;&nbsp;&nbsp;
@@ -394,10 +594,13 @@ var %(id)s_last_turn_drawn = -1;
 var %(id)s_refresh = 0;
 
 var %(id)s_max_turn = %(final_turn)d;
-var %(id)s_events = %(javascript_event_list)s;
+var %(id)s_events = %(id)s_decode_events(%(javascript_event_list)s);
 var %(id)s_turn_to_event = %(javascript_turn_to_event)s;
+var %(id)s_keyframes = %(javascript_keyframes)s;
 var %(id)s_background = %(javascript_background)s;
 var %(id)s_domain = [];
+var %(id)s_terrain = null;
+var %(id)s_paths = null;
 
 var %(id)s_civs = %(javascript_civs)s;
 
@@ -407,10 +610,50 @@ var %(id)s_histogram_scale_w = %(histogram_scale_w)f;
 var %(id)s_histogram_scale_h = %(histogram_scale_h)f;
 var %(id)s_histogram = %(javascript_histogram_score)s;
 
-var %(id)s_timeout = null;
+var %(id)s_animation = null;
+var %(id)s_speed = %(turns_per_second)d; // turns per second
+var %(id)s_speeds = [2, 5, 10, 20, 50];
+var %(id)s_play_time = null;
+var %(id)s_play_credit = 0;
 
 var %(id)s_border_alpha = 0.2;
 
+// Unpack a column of numbers written by javascript_column()
+function %(id)s_decode_column(type, data) {
+    var sizes = {"Int8": 1, "Int16": 2, "Int32": 4};
+    var bin = atob(data);
+    var bytes = new Uint8Array(bin.length);
+    for(var i=0; i<bin.length; ++i) {
+        bytes[i] = bin.charCodeAt(i);
+    }
+    var view = new DataView(bytes.buffer);
+    var get = view["get" + type];
+    var size = sizes[type];
+    var col = new Array(bin.length / size);
+    for(var i=0; i<col.length; ++i) {
+        col[i] = get.call(view, i*size, true);
+    }
+    return col;
+}
+
+// Unpack the compact event list written by javascript_event_list() into
+// [turn, x, y, background, foreground, text, city, city name] arrays
+function %(id)s_decode_events(packed) {
+    var columns = {};
+    for(var name in packed.columns) {
+        columns[name] = %(id)s_decode_column(packed.columns[name][0], packed.columns[name][1]);
+    }
+    var palette = packed.palette;
+    var strings = packed.strings;
+    var events = new Array(columns.turn.length);
+    for(var i=0; i<events.length; ++i) {
+        events[i] = [columns.turn[i], columns.x[i], columns.y[i],
+            palette[columns.bg[i]], palette[columns.fg[i]],
+            strings[columns.text[i]], columns.city[i], strings[columns.city_name[i]]];
+    }
+    return events;
+}
+
 // Set up the canvas and the other HTML areas
 function %(id)s_setup() {
     var canvas = document.getElementById('%(id)s_canvas');
@@ -421,6 +664,8 @@ function %(id)s_setup() {
     if(%(id)s_background.length <= 0) {
         %(id)s_border_alpha = 1.0;
     }
+    %(id)s_paths = %(id)s_make_paths();
+    %(id)s_draw_terrain();
     %(id)s_render_turn(%(start_turn)d);
     %(id)s_advance_turn();
 }
@@ -437,7 +682,7 @@ function %(id)s_toggle_alpha() {
     }
     %(id)s_border_alpha = ba;
     %(id)s_refresh = 1;
-    if(%(id)s_timeout === null) {
+    if(%(id)s_animation === null) {
         %(id)s_stop_animation();
     }
 }
@@ -446,17 +691,26 @@ function %(id)s_toggle_alpha() {
 function %(id)s_stop_animation() {
     var turn = %(id)s_last_turn_drawn;
     %(id)s_render_turn(turn);
-    if(%(id)s_timeout === null) return;
-    clearTimeout(%(id)s_timeout);
-    %(id)s_timeout = null;
+    if(%(id)s_animation === null) return;
+    cancelAnimationFrame(%(id)s_animation);
+    %(id)s_animation = null;
 }
 
 // Toggle playback
 function %(id)s_toggle_animation() {
-    if(%(id)s_timeout === null) %(id)s_advance_turn();
+    if(%(id)s_animation === null) %(id)s_advance_turn();
     else %(id)s_stop_animation();
 }
 
+// Cycle through the playback speeds
+function %(id)s_toggle_speed() {
+    var speeds = %(id)s_speeds;
+    var i = 0;
+    while(i < speeds.length && speeds[i] <= %(id)s_speed) ++i;
+    %(id)s_speed = i < speeds.length ? speeds[i] : speeds[0];
+    document.getElementById("%(id)s_speed").innerHTML = %(id)s_speed + "/s";
+}
+
 // Switch to histogram
 function %(id)s_show_histogram() {
     %(id)s_stop_animation();
@@ -480,11 +734,11 @@ function %(id)s_frame(x) {
     %(id)s_render_turn(x);
 }
 
-// Draw the next turn and set up a timer to continue the animation
+// Draw the next turn and play on from there
 function %(id)s_advance_turn() {
-    if(%(id)s_timeout !== null) {
-        clearTimeout(%(id)s_timeout);
-        %(id)s_timeout = null;
+    if(%(id)s_animation !== null) {
+        cancelAnimationFrame(%(id)s_animation);
+        %(id)s_animation = null;
     }
     turn = %(id)s_last_turn_drawn + 1;
     if(turn == 0) turn = %(start_turn)d;
@@ -492,7 +746,31 @@ function %(id)s_advance_turn() {
     if(turn >= %(id)s_max_turn) {
         return;
     }
-    %(id)s_timeout = setTimeout(%(id)s_advance_turn, 100);
+    %(id)s_play_time = null;
+    %(id)s_play_credit = 0;
+    %(id)s_animation = requestAnimationFrame(%(id)s_play);
+}
+
+// Draw the turns that have become due at the chosen speed since the last
+// frame. Turns that are due at once are drawn in one go, and frames that
+// come late just have more turns to draw, so the speed doesn't depend on
+// how long a turn takes to draw.
+function %(id)s_play(now) {
+    if(%(id)s_play_time !== null) {
+        // at most a second's worth, e.g. after the page was hidden
+        %(id)s_play_credit += Math.min(now - %(id)s_play_time, 1000) * %(id)s_speed / 1000;
+    }
+    %(id)s_play_time = now;
+    var turns = Math.floor(%(id)s_play_credit);
+    if(turns > 0) {
+        %(id)s_play_credit -= turns;
+        %(id)s_render_turn(Math.min(%(id)s_last_turn_drawn + turns, %(id)s_max_turn));
+    }
+    if(%(id)s_last_turn_drawn >= %(id)s_max_turn) {
+        %(id)s_animation = null;
+        return;
+    }
+    %(id)s_animation = requestAnimationFrame(%(id)s_play);
 }
 
 // Find a neighbour sharing a given border with a hex tile
@@ -582,7 +860,35 @@ function %(id)s_set_sign(x, y, bg, fg, text) {
     parent.appendChild(stext);
 }
 
-// Draw the map as of a given turn
+// Return the index of the first event on or after a turn
+function %(id)s_event_at(turn) {
+    if(turn < %(id)s_turn_to_event.length) return %(id)s_turn_to_event[turn];
+    return %(id)s_events.length;
+}
+
+// Find the last keyframe at or before a turn, as [turn, indices of the
+// events that set the owned tiles before that turn], or null if there's none
+function %(id)s_keyframe(turn) {
+    var keyframes = %(id)s_keyframes;
+    for(var k=keyframes.length-1; k>=0; --k) {
+        var keyframe = keyframes[k];
+        if(keyframe[0] > turn) continue;
+        if(keyframe.length > 2) {
+            // the indices are stored as differences to the previous one
+            var owned = %(id)s_decode_column(keyframe[1], keyframe[2]);
+            for(var i=1; i<owned.length; ++i) {
+                owned[i] += owned[i-1];
+            }
+            keyframe = [keyframe[0], owned];
+            keyframes[k] = keyframe;
+        }
+        return keyframe;
+    }
+    return null;
+}
+
+// Draw the map as of a given turn. Going back, or further ahead than the
+// next keyframe, starts over from the last keyframe before the turn.
 function %(id)s_render_turn(turn) {
     if(turn < 0) {
         turn = 0;
@@ -592,33 +898,28 @@ function %(id)s_render_turn(turn) {
         %(id)s_last_turn_drawn = -1;
     }
     var txt = [];
-    if(%(id)s_last_turn_drawn < 0 || %(id)s_last_turn_drawn > turn) {
+    var start = %(id)s_event_at(%(id)s_last_turn_drawn + 1);
+    var keyframe = %(id)s_keyframe(turn);
+    tiles = {};
+    if(%(id)s_last_turn_drawn < 0 || %(id)s_last_turn_drawn > turn || (keyframe && keyframe[0] > %(id)s_last_turn_drawn + 1)) {
         %(id)s_reset_signs();
-        %(id)s_c.fillStyle = "rgb(220,220,180)";
-        %(id)s_c.fillRect(0, 0, %(html_w)d, %(html_h)d);
-        if(%(id)s_background.length > 0) {
-            for(var y=0; y<%(h)d; ++y) {
-                if(y >= %(id)s_background.length) break;
-                for(var x=0; x<%(w)d; ++x) {
-                    if(x >= %(id)s_background[y].length) break;
-                    bg = %(id)s_background[y][x][0];
-                    hf = %(id)s_background[y][x][1];
-                    rf = %(id)s_background[y][x][2];
-                    %(id)s_draw_hex_tile(x, y, bg, "", 0, hf, rf);
-                }
-            }
-        }
+        %(id)s_c.drawImage(%(id)s_terrain, 0, 0);
         %(id)s_domain = Array(%(h)d);
         for(var y=0; y<=%(h)d; ++y) {
             %(id)s_domain[y] = Array(%(w)d+1);
         }
-    }
-    var start = 0;
-    if(%(id)s_last_turn_drawn < turn && %(id)s_last_turn_drawn >= 0) {
-        start = %(id)s_turn_to_event[turn];
+        start = 0;
+        if(keyframe) {
+            start = %(id)s_event_at(keyframe[0]);
+            var owned = keyframe[1];
+            for(var i=0; i<owned.length; ++i) {
+                evt = %(id)s_events[owned[i]];
+                %(id)s_domain[evt[2]][evt[1]] = [evt[3], evt[4], evt[6], evt[7]];
+                tiles[""+evt[1]+","+evt[2]] = [evt[1], evt[2]];
+            }
+        }
     }
     var c = %(id)s_c;
-    tiles = {};
     for(var i=start; i<%(id)s_events.length; ++i) {
         evt = %(id)s_events[i];
         if(evt[0] > turn) {
@@ -630,12 +931,6 @@ function %(id)s_render_turn(turn) {
         if(evt[3] != "") {
             var x = evt[1];
             var y = evt[2];
-            dom = %(id)s_domain[y][x]
-            if(dom) {
-                if(evt[6] == 1 && evt[7] == "") {
-                    evt[7] = dom[3];
-                }
-            }
             %(id)s_domain[y][x] = [evt[3], evt[4], evt[6], evt[7]];
             tiles[""+x+","+y] = [x, y];
             for(var j=0; j<6; ++j) {
@@ -650,11 +945,7 @@ function %(id)s_render_turn(turn) {
         x = t[0];
         y = t[1];
         d = %(id)s_domain[y][x];
-        if(%(id)s_background.length > 0) {
-            %(id)s_draw_hex_tile(x, y, %(id)s_background[y][x][0], "", 0, %(id)s_background[y][x][1], %(id)s_background[y][x][2]);
-        } else {
-            %(id)s_draw_hex_tile(x, y, "rgb(220,220,180)", "", 0, 0, 0);
-        }
+        %(id)s_draw_terrain_tile(x, y);
         if(!d) continue;
         if(%(id)s_background.length <= 0) {
             %(id)s_draw_hex_tile(x, y, d[0], "", 0, 0, 0, %(id)s_border_alpha);
@@ -701,6 +992,97 @@ function %(id)s_render_turn(turn) {
     %(id)s_last_turn_drawn = turn;
 }
 
+// Make the shapes drawn for every tile once, relative to the top left
+// corner of the tile: the hex, the city symbol and the inner (0) and
+// outer (1) border strips for each of the six sides
+function %(id)s_make_paths() {
+    var s = %(tile_size)f;
+    var paths = {};
+    paths.hex = new Path2D();
+    paths.hex.moveTo(s/2, 0);
+    paths.hex.lineTo(s, s/3);
+    paths.hex.lineTo(s, 2*s/3);
+    paths.hex.lineTo(s/2, s);
+    paths.hex.lineTo(0, 2*s/3);
+    paths.hex.lineTo(0, s/3);
+    paths.hex.lineTo(s/2, 0);
+    paths.city_outer = new Path2D();
+    paths.city_outer.arc(s/2, s/2, s/4, 0, Math.PI*2, true);
+    paths.city_inner = new Path2D();
+    paths.city_inner.arc(s/2, s/2, s/6, 0, Math.PI*2, true);
+    // outer corners and inner corners of each side
+    var sides = [
+        [s/2, 0, s, s/3, s/2-s/8, s/12, s, s/3+s/6],
+        [s, s/3, s, 2*s/3, s-s/9, s/3-s/12, s-s/9, 2*s/3+s/12],
+        [s, 2*s/3, s/2, s, s, 2*s/3-s/6, s/2-s/8, s-s/12],
+        [0, 2*s/3, s/2, s, 0, 2*s/3-s/6, s/2+s/8, s-s/12],
+        [0, s/3, 0, 2*s/3, s/9, s/3-s/12, s/9, 2*s/3+s/12],
+        [s/2, 0, 0, s/3, s/2+s/8, s/12, 0, s/3+s/6]
+    ];
+    paths.borders = [[], []];
+    for(var b=0; b<6; ++b) {
+        var p = sides[b];
+        var inner = new Path2D();
+        inner.moveTo(p[0], p[1]);
+        inner.lineTo(p[2], p[3]);
+        inner.lineTo(p[6], p[7]);
+        inner.lineTo(p[4], p[5]);
+        paths.borders[0].push(inner);
+        var outer = new Path2D();
+        outer.moveTo(p[0], p[1]);
+        outer.lineTo(p[2], p[3]);
+        outer.lineTo((p[2]+p[6])/2, (p[3]+p[7])/2);
+        outer.lineTo((p[0]+p[4])/2, (p[1]+p[5])/2);
+        paths.borders[1].push(outer);
+    }
+    return paths;
+}
+
+// Draw the background into an offscreen canvas once, so that the map can
+// be cleared by copying from there
+function %(id)s_draw_terrain() {
+    var terrain = document.createElement("canvas");
+    terrain.width = %(html_w)d;
+    terrain.height = %(html_h)d;
+    // the drawing functions draw to %(id)s_c
+    var c = %(id)s_c;
+    %(id)s_c = terrain.getContext("2d");
+    %(id)s_c.fillStyle = "rgb(220,220,180)";
+    %(id)s_c.fillRect(0, 0, %(html_w)d, %(html_h)d);
+    if(%(id)s_background.length > 0) {
+        for(var y=0; y<%(h)d; ++y) {
+            if(y >= %(id)s_background.length) break;
+            for(var x=0; x<%(w)d; ++x) {
+                if(x >= %(id)s_background[y].length) break;
+                bg = %(id)s_background[y][x][0];
+                hf = %(id)s_background[y][x][1];
+                rf = %(id)s_background[y][x][2];
+                %(id)s_draw_hex_tile(x, y, bg, "", 0, hf, rf);
+            }
+        }
+    }
+    %(id)s_c = c;
+    %(id)s_terrain = terrain;
+}
+
+// Clear a tile by copying it from the background
+function %(id)s_draw_terrain_tile(x, y) {
+    var c = %(id)s_c;
+    x = x * 1.0;
+    y = y * 1.0;
+    if((%(h)d-y)%%2 == 0) {
+        x += 0.5;
+    }
+    s = %(tile_size)f;
+    x = s * (x + 0.5);
+    y = (2*s/3) * (y + 0.5);
+    c.save();
+    c.translate(x, y);
+    c.clip(%(id)s_paths.hex);
+    c.drawImage(%(id)s_terrain, x, y, s, s, 0, 0, s, s);
+    c.restore();
+}
+
 // Draw a city symbol
 function %(id)s_draw_city(x, y, bg, fg) {
     var c = %(id)s_c;
@@ -712,18 +1094,18 @@ function %(id)s_draw_city(x, y, bg, fg) {
     s = %(tile_size)f;
     x = s * (x + 0.5);
     y = (2*s/3) * (y + 0.5);
-    c.beginPath();
-    c.arc(x+s/2, y+s/2, s/4, 0, Math.PI*2, true);
+    c.save();
+    c.translate(x, y);
     c.fillStyle = bg;
-    c.fill();
-    c.beginPath();
-    c.arc(x+s/2, y+s/2, s/6, 0, Math.PI*2, true);
+    c.fill(%(id)s_paths.city_outer);
     c.fillStyle = fg;
-    c.fill();
+    c.fill(%(id)s_paths.city_inner);
+    c.restore();
 }
 
 // Draw a single border
 function %(id)s_draw_hex_border(x, y, col, b, outer) {
+    if(b < 0 || b > 5) return;
     var c = %(id)s_c;
     x = x * 1.0;
     y = y * 1.0;
@@ -733,88 +1115,11 @@ function %(id)s_draw_hex_border(x, y, col, b, outer) {
     s = %(tile_size)f;
     x = s * (x + 0.5);
     y = (2*s/3) * (y + 0.5);
-    switch(b) {
-    case 0:
-        xo1 = x+s/2;
-        yo1 = y;
-        xo2 = x+s;
-        yo2 = y+s/3;
-        xi1 = xo1-s/8;
-        yi1 = yo1+s/12;
-        xi2 = xo2;
-        yi2 = yo2+s/6;
-        break;
-    case 1:
-        xo1 = x+s;
-        yo1 = y+s/3;
-        xo2 = x+s;
-        yo2 = y+2*s/3;
-        xi1 = xo1-s/9;
-        yi1 = yo1-s/12;
-        xi2 = xo2-s/9;
-        yi2 = yo2+s/12;
-        break;
-    case 2:
-        xo1 = x+s;
-        yo1 = y+2*s/3;
-        xo2 = x+s/2;
-        yo2 = y+s;
-        xi1 = xo1;
-        yi1 = yo1-s/6;
-        xi2 = xo2-s/8;
-        yi2 = yo2-s/12;
-        break;
-    case 3:
-        xo1 = x;
-        yo1 = y+2*s/3;
-        xo2 = x+s/2;
-        yo2 = y+s;
-        xi1 = xo1;
-        yi1 = yo1-s/6;
-        xi2 = xo2+s/8;
-        yi2 = yo2-s/12;
-        break;
-    case 4:
-        xo1 = x;
-        yo1 = y+s/3;
-        xo2 = x;
-        yo2 = y+2*s/3;
-        xi1 = xo1+s/9;
-        yi1 = yo1-s/12;
-        xi2 = xo2+s/9;
-        yi2 = yo2+s/12;
-        break;
-    case 5:
-        xo1 = x+s/2;
-        yo1 = y;
-        xo2 = x;
-        yo2 = y+s/3;
-        xi1 = xo1+s/8;
-        yi1 = yo1+s/12;
-        xi2 = xo2;
-        yi2 = yo2+s/6;
-        break;
-    default:
-        return;
-    }
-    xm1 = (xo1+xi1)/2;
-    ym1 = (yo1+yi1)/2;
-    xm2 = (xo2+xi2)/2;
-    ym2 = (yo2+yi2)/2;
+    c.save();
+    c.translate(x, y);
     c.fillStyle = col;
-    c.beginPath();
-    if(outer == 0) {
-        c.moveTo(xo1, yo1);
-        c.lineTo(xo2, yo2);
-        c.lineTo(xi2, yi2);
-        c.lineTo(xi1, yi1);
-    } else {
-        c.moveTo(xo1, yo1);
-        c.lineTo(xo2, yo2);
-        c.lineTo(xm2, ym2);
-        c.lineTo(xm1, ym1);
-    }
-    c.fill();
+    c.fill(%(id)s_paths.borders[outer == 0 ? 0 : 1][b]);
+    c.restore();
 }
 
 // Draw a single hex tile
@@ -838,28 +1143,20 @@ function %(id)s_draw_hex_tile(tx, ty, bg, fg, et, hf, rf, bgalpha, fgalpha) {
     s = %(tile_size)f;
     x = s * (x + 0.5);
     y = (2*s/3) * (y + 0.5);
+    c.translate(x, y);
     c.fillStyle = bg;
-    c.beginPath();
-    c.moveTo(x+s/2, y);
-    c.lineTo(x+s, y+s/3);
-    c.lineTo(x+s, y+2*s/3);
-    c.lineTo(x+s/2, y+s);
-    c.lineTo(x, y+2*s/3);
-    c.lineTo(x, y+s/3);
-    c.lineTo(x+s/2, y);
     c.globalAlpha = bgalpha;
-    c.fill();
+    c.fill(%(id)s_paths.hex);
     c.globalAlpha = fgalpha;
     if(fg != "") {
         c.strokeStyle = fg;
-        c.stroke();
+        c.stroke(%(id)s_paths.hex);
     }
     if(et == 1) {
         c.fillStyle = fg;
-        c.beginPath();
-        c.arc(x+s/2, y+s/2, s/4, 0, Math.PI*2, true);
-        c.fill();
+        c.fill(%(id)s_paths.city_outer);
     }
+    c.translate(-x, -y);
     if(hf == -1) { // ice
         c.strokeStyle = "#ffffff";
         c.globalAlpha = 0.7;
@@ -943,53 +1240,185 @@ if(window.addEventListener) {
 --></script>
 """
 
+# number of chunks write_html() collects before writing them out
+html_chunk_count = 1000
+
+def split_template(template, names):
+    """ Split a %-style template at the %(name)s placeholders for the given names. Returns a list of (template, name) pairs, where name is the placeholder following that part of the template, or None for the last part. """
+    parts = []
+    start = 0
+    for m in re.finditer(r"%%|%\((\w+)\)s", template):
+        if m.group(1) in names:
+            parts.append((template[start:m.start()], m.group(1)))
+            start = m.end()
+    parts.append((template[start:], None))
+    return parts
+
+def write_chunks(fp, chunks, encoding):
+    """ Write a list of strings to a file-like object in one go, encoding them if an encoding is given """
+    data = u"".join(chunks)
+    if encoding is not None:
+        data = data.encode(encoding)
+    fp.write(data)
+
+# typed arrays for the numeric columns of the compact javascript event list,
+# smallest first: (array typecode, javascript type, minimum, maximum)
+javascript_int_types = [
+    ("b", "Int8", -0x80, 0x7f),
+    ("h", "Int16", -0x8000, 0x7fff),
+    ("i", "Int32", -0x80000000, 0x7fffffff),
+]
+
+def javascript_column(values):
+    """ Pack a list of integers into the smallest typed array that holds them. Returns the javascript type name and the little endian data encoded as base64. """
+    lo = min(values) if values else 0
+    hi = max(values) if values else 0
+    for code, name, mn, mx in javascript_int_types:
+        if mn <= lo and hi <= mx:
+            break
+    data = array.array(code, values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return name, base64.b64encode(data.tostring())
+
+
+# precompiled decoders for the little endian values in Civ 5 files
+byte_struct = struct.Struct("<B")
+int_struct = struct.Struct("<i")
+
 class Civ5FileReader(object):
     """ Some basic functionality for reading data from Civ 5 files. """
 
-    def __init__(self, input):
+    def __init__(self, input, buffered=True, context=None):
         if isinstance(input, str):
             input = file(input, "rb")
         self.r = input
+        if context is None:
+            context = Civ5Context(locale, debug)
+        self.context = context
+        if context.profile is not None:
+            context.profile.add(self)
+        self.eof = False
+
+        # In buffered mode, the file is memory mapped (or read in one go if
+        # that isn't possible) and everything is decoded in place from the
+        # buffer at offset self.pos. Otherwise, every read goes to self.r.
+        self.buffered = buffered
+        self.buf = None
+        self.buf_size = 0
+        self.pos = 0
+        if buffered:
+            self.load_buffer()
+
+    def load_buffer(self):
+        """ Load the remainder of the input stream into the read buffer """
+        try:
+            pos = self.r.tell()
+            buf = mmap.mmap(self.r.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            # not a regular file (pipe, StringIO, socket, ...) or empty
+            pos = 0
+            buf = self.r.read()
+        self.buf = buf
+        self.buf_size = len(buf)
+        self.pos = pos
+
+    def tell(self):
+        """ Return the current read offset """
+        if self.buf is None:
+            return self.r.tell()
+        return self.pos
+
+    def seek(self, offset):
+        """ Continue reading at the given offset """
+        if self.buf is None:
+            self.r.seek(offset)
+        else:
+            self.pos = offset
+
+    def read_bytes(self, size):
+        """ Read a block of up to size raw bytes, or everything that's left if size is negative """
+        if self.buf is None:
+            return self.r.read(size)
+        start = self.pos
+        if size < 0 or start + size > self.buf_size:
+            self.pos = self.buf_size
+        else:
+            self.pos = start + size
+        return self.buf[start:self.pos]
 
     def read_byte(self):
         """ Read a single byte as an integer value """
-        t = self.r.read(1)
-        if len(t) != 1:
+        if self.buf is None:
+            t = self.r.read(1)
+            if len(t) != 1:
+                self.eof = True
+                return 0
+            return ord(t)
+        pos = self.pos
+        if pos + 1 > self.buf_size:
             self.eof = True
             return 0
-        return ord(t)
+        self.pos = pos + 1
+        return byte_struct.unpack_from(self.buf, pos)[0]
 
     def read_int(self):
         """ Read a single little endian 4 byte integer """
         # My *guess* is that they're all signed
-        t = self.r.read(4)
-        if len(t) != 4:
+        if self.buf is None:
+            t = self.r.read(4)
+            if len(t) != 4:
+                self.eof = True
+                return 0
+            return int_struct.unpack(t)[0]
+        pos = self.pos
+        if pos + 4 > self.buf_size:
+            self.pos = self.buf_size
             self.eof = True
             return 0
-        return struct.unpack("<i", t)[0]
+        self.pos = pos + 4
+        return int_struct.unpack_from(self.buf, pos)[0]
+
+    def read_int_array(self, count):
+        """ Read count little endian 4 byte integers with a single unpack call and return them in a list. Missing values at the end of the file are returned as 0. """
+        if count <= 0:
+            return []
+        if self.buf is None:
+            t = self.r.read(4*count)
+            n = len(t) // 4
+            values = list(struct.unpack("<%di" % n, t[:4*n]))
+        else:
+            n = min(count, (self.buf_size - self.pos) // 4)
+            values = list(struct.unpack_from("<%di" % n, self.buf, self.pos))
+            self.pos += 4*n
+        if n < count:
+            self.eof = True
+            values.extend([0] * (count - n))
+        return values
 
     def read_ints(self, count=None, esize=1):
         """ Read count tuples of esize little endian 4 byte integers and return them in a list. If count is omitted, read it as a 4 byte integer first """
         if count is None:
             count = self.read_int()
-        list = []
-        while count > 0:
-            if esize > 1:
-                t = []
-                for i in range(esize):
-                    t.append(self.read_int())
-                list.append(tuple(t))
-            else:
-                list.append(self.read_int())
-            count -= 1
-        return list
+        values = self.read_int_array(count * esize)
+        if esize > 1:
+            return zip(*[iter(values)] * esize)
+        return values
 
     def read_string(self):
         """ Read an undelimited string with the length given in the first 4 bytes """
-        return self.r.read(self.read_int()).decode("utf-8", 'replace')
+        return self.read_bytes(self.read_int()).decode("utf-8", 'replace')
 
     def read_terminated_string(self):
         """ Read a nul-terminated string. """
+        if self.buf is not None:
+            end = self.buf.find("\0", self.pos)
+            if end < 0:
+                self.eof = True
+                end = self.buf_size
+            s = self.buf[self.pos:end]
+            self.pos = min(end + 1, self.buf_size)
+            return s.decode("utf-8", 'replace')
         s = ""
         while True:
             c = self.r.read(1)
@@ -1008,7 +1437,7 @@ class Civ5FileReader(object):
 
     def read_sized_string_list(self, size):
         """ Read a block of data with a given size, and split in null-terminated strings. """
-        block = self.r.read(size)
+        block = self.read_bytes(size)
         if block.endswith("\0"):
             block = block[:-1]
         return block.split("\0")
@@ -1016,8 +1445,8 @@ class Civ5FileReader(object):
 class Civ5Map(Civ5FileReader):
     """ Encapsulates a Civ V map, and can load Civ5Map files. """
 
-    def __init__(self, input):
-        Civ5FileReader.__init__(self, input)
+    def __init__(self, input, buffered=True, context=None):
+        Civ5FileReader.__init__(self, input, buffered, context)
         
         # map dimensions
         self.w = 0
@@ -1028,7 +1457,10 @@ class Civ5Map(Civ5FileReader):
     def load_file(self, f):
         """ Loads a Civ5Map file from a stream. """
 
-        self.r = f
+        if f is not self.r:
+            self.r = f
+            if self.buffered:
+                self.load_buffer()
         
         first_byte = self.read_byte()   # type/version indicator
         self.is_scenario = first_byte & 0x80
@@ -1038,7 +1470,7 @@ class Civ5Map(Civ5FileReader):
         self.w = self.read_int()
         self.h = self.read_int()
 
-        f.read(1)   # no idea
+        self.read_bytes(1)   # no idea
 
         self.read_int() # no idea
         terrain_len = self.read_int()  # length of terrain XML id block in bytes
@@ -1052,36 +1484,47 @@ class Civ5Map(Civ5FileReader):
         # terrain/feature/resource identifiers as in XML
         self.terrains = self.read_sized_string_list(terrain_len)
         self.features = self.read_sized_string_list(feat1_len)
-        f.read(feat2_len)
+        self.read_bytes(feat2_len)
         self.resources = self.read_sized_string_list(resource_len)
 
         # for exported maps, the name will be the filename (w/o extension) and description will be blank
-        self.map_name = f.read(string1_len)
-        self.map_description = f.read(string2_len)
+        self.map_name = self.read_bytes(string1_len)
+        self.map_description = self.read_bytes(string2_len)
 
         # new string for version 0xb and later
         if (self.map_version >= 0x0b):
             string3_len = self.read_int()
-            f.read(string3_len)
-
-        self.map = []
-        debugout = []
-        for y in range(self.h):
-            self.map.insert(0, [])
-            if debug:
-                debugout.insert(0, "")
-            for x in range(self.w):
-                tf = struct.unpack("bbbbbbbb", f.read(8))
-                if debug:
-                    if tf[4] == 2:
-                        debugout[0] += 'M' # mountain
-                    elif tf[4] == 1:
-                        debugout[0] += self.get_terrain(tf[0])[8]
+            self.read_bytes(string3_len)
+
+        # The tile block holds 8 signed bytes per tile, bottom row first:
+        # terrain id, resource id, feature id, river flags, hill flag and
+        # three bytes of unknown purpose. Flip the row order in one go so
+        # that the top row comes first, then split the block into one
+        # column per field.
+        row_len = 8 * self.w
+        block = self.read_bytes(row_len * self.h)
+        if len(block) != row_len * self.h:
+            raise struct.error("Civ5Map tile data is truncated")
+        block = "".join([ block[i:i+row_len] for i in range(len(block)-row_len, -1, -row_len) ])
+        self.tile_terrain = array.array("b", block[0::8])
+        self.tile_resource = array.array("b", block[1::8])
+        self.tile_feature = array.array("b", block[2::8])
+        self.tile_river = array.array("b", block[3::8])
+        self.tile_hill = array.array("b", block[4::8])
+        self.map_rows = None
+
+        if self.context.debug:
+            debugout = []
+            for y in range(self.h):
+                line = ""
+                for i in range(y*self.w, (y+1)*self.w):
+                    if self.tile_hill[i] == 2:
+                        line += 'M' # mountain
+                    elif self.tile_hill[i] == 1:
+                        line += self.get_terrain(self.tile_terrain[i])[8]
                     else:
-                        debugout[0] += self.get_terrain(tf[0])[8].lower()
-                # terrain id, resource id, feature id, hill flag, river flag
-                self.map[0].append( (self.get_terrain(tf[0]), self.get_resource(tf[1]), self.get_feature(tf[2]), tf[4], tf[3]) )
-        if debug:
+                        line += self.get_terrain(self.tile_terrain[i])[8].lower()
+                debugout.append(line)
             sys.stdout.write("\n".join(debugout)+"\n")
 
     def get_terrain(self, id):
@@ -1093,71 +1536,86 @@ class Civ5Map(Civ5FileReader):
     def get_feature(self, id):
         return self.features[id]
 
+    def tile(self, x, y):
+        """ Return a (terrain, resource, feature, hill flag, river flag) tuple for a tile, with row 0 at the top """
+        i = y*self.w + x
+        return (self.get_terrain(self.tile_terrain[i]), self.get_resource(self.tile_resource[i]), self.get_feature(self.tile_feature[i]), self.tile_hill[i], self.tile_river[i])
+
+    @property
+    def map(self):
+        """ The whole map as a list of rows of tile() tuples, top row first. Only built when it's first used. """
+        if self.map_rows is None:
+            self.map_rows = [ [ self.tile(x, y) for x in range(self.w) ] for y in range(self.h) ]
+        return self.map_rows
+
     def map_info(self):
         """ Provide some basic human-readable description of the map. """
         return "%d x %d" % (self.w, self.h)
 
 class Civ5ReplayEvent(object):
-    """ Encapsulates a single event in a replay. """
+    """ Encapsulates a single event in a replay. The event data lives in a row of a Civ5EventStore. """
 
-    def __init__(self, event_data, event_text, is_last=False):
-        # every event appears to start with 0xffffffff
-        self.data = event_data
-        self.text = event_text
-        
-        # record_type appears to be either 1 (an event) or 0 (final entry with the map data)
-        self.record_type = self.data[0]
-       
-        # the following fields are only valid for type 0 records
-        if self.record_type == 0 or is_last:
-            self.start_turn = self.record_type
-            self.record_type = 0
+    __slots__ = ("store", "index")
 
-            # The starting year, BC is negative
-            self.start_year = self.data[1]
-
-            # The final turn count
-            self.turn = self.data[2]
-
-            # be nice to unsuspecting users
-            self.event_type = 0
-            self.x = -1
-            self.y = -1
-            self.civ = 0
-
-        elif self.record_type == 1:
-            # the following fields are only valid for type 1 records
-            # the turn number the event happens on, 0 is initial setup 
-            self.turn = self.data[1]
-
-            # event type seems to be one of the following values:
-            #  0    general information
-            #  1    city founded
-            #  2    culture gained 
-            self.event_type = self.data[2]
-
-            # map tile where the event happened, note that -1 are valid for events
-            # not tied to a specific map tile (e.g. declarations of war)
-            self.x = self.data[3]
-            self.y = self.data[4]
-
-            # which player this event is from, starting with 1; city states are all -1
-            self.civ = self.data[5]
-
-        # helpers
-        self.city_name = None
-        self.city = 0
-        self.last_event = False
+    def __init__(self, event_data, event_text, is_last=False, store=None):
+        # events read from a replay are added to the replay's store,
+        # any other events get a store of their own
+        if store is None:
+            store = Civ5EventStore()
+        self.store = store
+        self.index = store.append(event_data, event_text, is_last)
 
     def set_last_event(self, b):
         """ Mark this event as the last event in the replay """
-        self.last_event = b
+        self.store.last_event[self.index] = b
 
     def is_last_event(self):
         """ Return True if this is the last event in the replay """
-        if self.last_event:
+        if self.store.last_event[self.index]:
             return True
-        return self.record_type == 0
+        return self.store.record_type[self.index] == 0
+
+    # record_type appears to be either 1 (an event) or 0 (final entry with the map data)
+    record_type = property(lambda self: self.store.record_type[self.index])
+    # the turn number the event happens on, 0 is initial setup; the final turn count for type 0
+    turn = property(lambda self: self.store.turn[self.index])
+    # event type seems to be one of the following values:
+    #  0    general information
+    #  1    city founded
+    #  2    culture gained 
+    event_type = property(lambda self: self.store.event_type[self.index])
+    # map tile where the event happened, note that -1 are valid for events
+    # not tied to a specific map tile (e.g. declarations of war)
+    x = property(lambda self: self.store.x[self.index])
+    y = property(lambda self: self.store.y[self.index])
+    # which player this event is from, starting with 1; city states are all -1
+    civ = property(lambda self: self.store.civ[self.index])
+    text = property(lambda self: self.store.strings[self.store.text[self.index]])
+
+    # the following fields are only valid for type 0 records
+    start_turn = property(lambda self: self.store.final[self.index][0])
+    # The starting year, BC is negative
+    start_year = property(lambda self: self.store.final[self.index][1])
+
+    # helpers
+    def get_city(self):
+        return self.store.city[self.index]
+    def set_city(self, city):
+        self.store.city[self.index] = city
+    city = property(get_city, set_city)
+
+    def get_city_name(self):
+        return self.store.get_string(self.store.city_name[self.index])
+    def set_city_name(self, name):
+        self.store.city_name[self.index] = self.store.intern(name)
+    city_name = property(get_city_name, set_city_name)
+
+    @property
+    def data(self):
+        """ The numbers in the event record """
+        if self.index in self.store.final:
+            return [ self.start_turn, self.start_year, self.turn, 0, 0, 0 ]
+        return [ self.record_type, self.turn, self.event_type, self.x, self.y, self.civ ]
 
     def update_map(self, lst):
         """ Update a list of lists with any map change stored in this event """
@@ -1178,34 +1636,379 @@ class Civ5ReplayEvent(object):
                     return
                 ln[self.x] = self.civ + 1
 
-    def update_domain(self, lst):
-        """ Update a list of lists of dictionaries with ownership changes """
+    def update_domain(self, domain):
+        """ Record any ownership change stored in this event in a Civ5Domain """
         if self.x < 0 or self.y < 0:
             return
-        while len(lst) <= self.y:
-            lst.append([])
-        ln = lst[self.y]
-        while len(ln) <= self.x:
-            ln.append({})
-        d = ln[self.x]
-        d[self.turn] = [ self.turn, self.civ, self.city, self.city_name ]
+        domain.record(self.turn, self.x, self.y, self.civ, self.city, self.city_name)
 
     def __str__(self):
+        context = self.store.context
         ret = u""
-        if debug:
+        if context.debug:
             ret = u"%-24s %02d %-20s " % (self.data, self.city, "[%s]"%(self.city_name,))
         if self.record_type == 0:
-            ret += L("[Turn %d] Game ends after %d turns in %s", fr="[Tour %d] Le jeu a pris fin après %d tours en %s") % (self.turn, self.turn, self.text)
+            ret += context.s(L("[Turn %d] Game ends after %d turns in %s", fr="[Tour %d] Le jeu a pris fin après %d tours en %s")) % (self.turn, self.turn, self.text)
         else:
-            ret += L("[Turn %d] %s",fr="[Tour %d] %s",de="[Runde %d] %s",es="[Turno %d] %s",it="[Turno %d] %s",ko="[턴 %d] %s",pl="[Tura %d] %s") % (self.turn, self.text)
+            ret += context.s(L("[Turn %d] %s",fr="[Tour %d] %s",de="[Runde %d] %s",es="[Turno %d] %s",it="[Turno %d] %s",ko="[턴 %d] %s",pl="[Tura %d] %s")) % (self.turn, self.text)
 
         return ret
 
+class Civ5EventStore(object):
+    """ Keeps the events of a replay in parallel arrays, one row per event. Texts and city names are kept once in a string table. """
+
+    def __init__(self, context=None):
+        if context is None:
+            context = Civ5Context(locale, debug)
+        self.context = context
+        self.record_type = array.array("b")
+        self.turn = array.array("i")
+        self.event_type = array.array("i")
+        self.x = array.array("i")
+        self.y = array.array("i")
+        self.civ = array.array("i")
+        self.city = array.array("b")
+        self.last_event = array.array("b")
+        self.razed = array.array("b")       # 1 if the tile was razed, see Civ5Replay.infer_razing()
+        self.text = array.array("i")        # index into strings
+        self.city_name = array.array("i")   # index into strings, -1 for None
+
+        # (start turn, start year) of type 0 records, by row
+        self.final = {}
+
+        # string table
+        self.strings = []
+        self.string_ids = {}
+
+    def intern(self, s):
+        """ Return the string table index of s, adding it if needed. None is -1. """
+        if s is None:
+            return -1
+        i = self.string_ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(s)
+            self.string_ids[s] = i
+        return i
+
+    def get_string(self, i):
+        """ Return the string at index i in the string table, or None for -1 """
+        if i < 0:
+            return None
+        return self.strings[i]
+
+    def append(self, event_data, event_text, is_last=False):
+        """ Add an event from the numbers in its record and its text, and return its row """
+        # every event appears to start with 0xffffffff
+        record_type = event_data[0]
+        if record_type == 0 or is_last:
+            self.final[len(self.turn)] = (record_type, event_data[1])
+            self.record_type.append(0)
+            self.turn.append(event_data[2])
+            # be nice to unsuspecting users
+            self.event_type.append(0)
+            self.x.append(-1)
+            self.y.append(-1)
+            self.civ.append(0)
+        else:
+            self.record_type.append(record_type)
+            self.turn.append(event_data[1])
+            self.event_type.append(event_data[2])
+            self.x.append(event_data[3])
+            self.y.append(event_data[4])
+            self.civ.append(event_data[5])
+        self.city.append(0)
+        self.last_event.append(0)
+        self.razed.append(0)
+        self.text.append(self.intern(event_text))
+        self.city_name.append(-1)
+        return len(self.turn) - 1
+
+    def __len__(self):
+        return len(self.turn)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.turn)
+        if i < 0 or i >= len(self.turn):
+            raise IndexError("event index out of range")
+        evt = Civ5ReplayEvent.__new__(Civ5ReplayEvent)
+        evt.store = self
+        evt.index = i
+        return evt
+
+    def __iter__(self):
+        for i in xrange(len(self.turn)):
+            yield self[i]
+
+    # the array columns, in the order get_state() stores them
+    columns = ("record_type", "turn", "event_type", "x", "y", "civ", "city", "last_event", "razed", "text", "city_name")
+
+    def get_state(self):
+        """ Return the events as a tuple of strings, lists and dictionaries, see set_state() """
+        return ([ getattr(self, c).tostring() for c in self.columns ], self.final, self.strings)
+
+    def set_state(self, state):
+        """ Replace the events with the ones in a tuple returned by get_state() """
+        data, self.final, self.strings = state
+        for c, d in zip(self.columns, data):
+            a = array.array(getattr(self, c).typecode)
+            a.fromstring(d)
+            setattr(self, c, a)
+        self.string_ids = dict((s, i) for i, s in enumerate(self.strings))
+
+# owner in Civ5Domain.grid() for tiles that have no owner information yet
+domain_unknown = -2
+
+class Civ5TileHistory(object):
+    """ The ownership changes of a single map tile, sorted by turn """
+
+    __slots__ = ("turns", "civs", "cities", "names", "city_flags", "city_names")
+
+    def __init__(self):
+        self.turns = array.array("i")
+        self.civs = array.array("i")
+        # city flag and name as recorded on each turn (0 and None if not known)
+        self.cities = array.array("b")
+        self.names = []
+        # most recent non-zero city flag and non-None city name up to each turn
+        self.city_flags = array.array("b")
+        self.city_names = []
+
+    def record(self, turn, civ, city, city_name):
+        """ Record the state of the tile on a given turn, replacing anything recorded for the same turn """
+        i = bisect.bisect_left(self.turns, turn)
+        if i < len(self.turns) and self.turns[i] == turn:
+            self.civs[i] = civ
+            self.cities[i] = city
+            self.names[i] = city_name
+        else:
+            self.turns.insert(i, turn)
+            self.civs.insert(i, civ)
+            self.cities.insert(i, city)
+            self.names.insert(i, city_name)
+            self.city_flags.insert(i, 0)
+            self.city_names.insert(i, None)
+        # everything after the change may depend on it
+        for j in range(i, len(self.turns)):
+            flag = 0
+            name = None
+            if j > 0:
+                flag = self.city_flags[j-1]
+                name = self.city_names[j-1]
+            if self.cities[j] != 0:
+                flag = self.cities[j]
+            if self.names[j] is not None:
+                name = self.names[j]
+            self.city_flags[j] = flag
+            self.city_names[j] = name
+
+    def index(self, turn):
+        """ Return the index of the last change on or before turn X, or -1 """
+        return bisect.bisect_right(self.turns, turn) - 1
+
+    def get_state(self):
+        """ Return the history as a tuple of strings and lists, see set_state() """
+        return (self.turns.tostring(), self.civs.tostring(), self.cities.tostring(), self.names,
+            self.city_flags.tostring(), self.city_names)
+
+    def set_state(self, state):
+        """ Replace the history with the one in a tuple returned by get_state() """
+        turns, civs, cities, self.names, city_flags, self.city_names = state
+        self.turns = array.array("i")
+        self.turns.fromstring(turns)
+        self.civs = array.array("i")
+        self.civs.fromstring(civs)
+        self.cities = array.array("b")
+        self.cities.fromstring(cities)
+        self.city_flags = array.array("b")
+        self.city_flags.fromstring(city_flags)
+
+    def info(self, turn):
+        """ Return [turn of last change, owner, city flag, city name] as of turn X """
+        i = self.index(turn)
+        if i < 0:
+            return [None]*4
+        flag = self.city_flags[i]
+        if flag == 0:
+            flag = None
+        return [ self.turns[i], self.civs[i], flag, self.city_names[i] ]
+
+class Civ5Domain(object):
+    """ Tile ownership history of a whole map """
+
+    def __init__(self):
+        self.tiles = {}
+        self.grid_cache = {}
+
+    def record(self, turn, x, y, civ, city, city_name):
+        """ Record the state of a tile on a given turn """
+        t = self.tiles.get((x, y))
+        if t is None:
+            t = self.tiles[(x, y)] = Civ5TileHistory()
+        t.record(turn, civ, city, city_name)
+        if len(self.grid_cache) > 0:
+            self.grid_cache.clear()
+
+    def get_state(self):
+        """ Return the ownership history as a list of (x, y, tile history state) tuples, see set_state() """
+        return [ (x, y, t.get_state()) for (x, y), t in self.tiles.iteritems() ]
+
+    def set_state(self, state):
+        """ Replace the ownership history with the one in a list returned by get_state() """
+        self.tiles = {}
+        self.grid_cache = {}
+        for x, y, s in state:
+            t = self.tiles[(x, y)] = Civ5TileHistory()
+            t.set_state(s)
+
+    def latest(self):
+        """ Return the most recent state of every tile as a list of (x, y, turn, owner, city flag, city name) tuples """
+        return [ (x, y, t.turns[-1], t.civs[-1], t.city_flags[-1], t.city_names[-1]) for (x, y), t in self.tiles.iteritems() ]
+
+    def info(self, turn, x, y):
+        """ Returns tile ownership on turn X as [turn of last change, owner, city flag, city name], or None if nothing is known about the tile """
+        t = self.tiles.get((x, y))
+        if t is None:
+            return None
+        return t.info(turn)
+
+    def grid(self, turn, w, h):
+        """ Returns the owner of every tile on turn X as an array of w*h integers, indexed by y*w+x. Tiles without an owner yet are domain_unknown. """
+        return array.array("i", self.grids(turn, w, h)[0])
+
+    def grids(self, turn, w, h):
+        """ Returns the owner and city flag (0 if none) of every tile on turn X as two arrays indexed by y*w+x. The arrays are cached and must not be changed. """
+        key = (turn, w, h)
+        if key in self.grid_cache:
+            return self.grid_cache[key]
+        owners = array.array("i", [domain_unknown]) * (w*h)
+        cities = array.array("b", [0]) * (w*h)
+        for (x, y), t in self.tiles.iteritems():
+            if x >= w or y >= h:
+                continue
+            i = t.index(turn)
+            if i >= 0:
+                owners[y*w+x] = t.civs[i]
+                cities[y*w+x] = t.city_flags[i]
+        # regions are usually looked at for a couple of consecutive turns
+        if len(self.grid_cache) >= 4:
+            self.grid_cache.clear()
+        self.grid_cache[key] = (owners, cities)
+        return owners, cities
+
+class Civ5Components(object):
+    """ Connected components of tiles with the same owner on a given turn. Components are labelled as they are asked for. """
+
+    def __init__(self, turn, owners, cities, w, h):
+        self.turn = turn
+        self.owners = owners
+        self.cities = cities
+        self.w = w
+        self.h = h
+        # component label of each tile, -1 if not labelled yet
+        self.labels = array.array("i", [-1]) * (w*h)
+        # the tiles with a city in them, by component label
+        self.city_tiles = []
+
+    def label(self, i):
+        """ Return the component label of the tile at index i (y*w+x), or -1 if it has no owner """
+        l = self.labels[i]
+        if l >= 0:
+            return l
+        owner = self.owners[i]
+        if owner == domain_unknown:
+            return -1
+        w = self.w
+        h = self.h
+        l = len(self.city_tiles)
+        city_tiles = []
+        self.city_tiles.append(city_tiles)
+        self.labels[i] = l
+        queue = collections.deque([ i ])
+        while len(queue) > 0:
+            t = queue.popleft()
+            if self.cities[t] == 1:
+                city_tiles.append(t)
+            x = t % w
+            y = t // w
+            xoff = y % 2
+            for nx, ny in ((x+xoff, y-1), (x+1, y), (x+xoff, y+1), (x-1+xoff, y+1), (x-1, y), (x-1+xoff, y-1)):
+                if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                    continue
+                n = ny*w+nx
+                if self.labels[n] < 0 and self.owners[n] == owner:
+                    self.labels[n] = l
+                    queue.append(n)
+        return l
+
+class Civ5Region(object):
+    """ A contiguous set of (x, y) tiles with the same owner on a given turn """
+
+    def __init__(self, turn, tiles):
+        self.turn = turn
+        self.tiles = tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __iter__(self):
+        return iter(self.tiles)
+
+    def __contains__(self, tile):
+        return tile in self.tiles
+
+class Civ5Histogram(object):
+    """ The statistics at the end of a replay: four values per civ and turn, the first of which is the score, kept in a single array indexed by (civ*turns + turn)*4 + value """
+
+    def __init__(self, civ_info, data):
+        # (unknown, unknown, number of turns with data) for each civ
+        self.civ_info = civ_info
+        self.civs = len(civ_info)
+        self.turns = max([0] + [ t for a, b, t in civ_info ])
+        # turns beyond the ones a civ has data for are 0
+        self.data = data
+
+    def column(self, civ, value=0):
+        """ Return one value of a civ for every turn """
+        start = civ*self.turns*4 + value
+        return self.data[start:start + self.turns*4:4]
+
+    def row(self, turn, value=0):
+        """ Return one value of every civ on a turn """
+        return self.data[turn*4 + value::self.turns*4]
+
+    def rows(self, value=0):
+        """ Generate the rows of one value for every turn """
+        for turn in xrange(self.turns):
+            yield self.row(turn, value)
+
+    def totals(self, value=0):
+        """ Return the sum of one value over all civs for every turn """
+        totals = array.array("i", [0]) * self.turns
+        for civ in xrange(self.civs):
+            totals = array.array("i", map(operator.add, totals, self.column(civ, value)))
+        return totals
+
+    def max_total(self, value=0):
+        """ Return the highest sum of one value over all civs on any turn """
+        return max([0] + list(self.totals(value)))
+
+    def get_state(self):
+        """ Return the histogram as a tuple of lists and strings, see set_state() """
+        return (self.civ_info, self.data.tostring())
+
+    def set_state(self, state):
+        """ Replace the histogram with the one in a tuple returned by get_state() """
+        civ_info, data = state
+        self.__init__(civ_info, array.array("i"))
+        self.data.fromstring(data)
+
 class Civ5Replay(Civ5FileReader):
     """ Provides access to data and sequential events in a replay file. """
 
-    def __init__(self, input):
-        Civ5FileReader.__init__(self, input)
+    def __init__(self, input, buffered=True, cache=None, context=None):
+        Civ5FileReader.__init__(self, input, buffered, context)
 
         # Localized strings and regexps
         self.l_In = L("In", fr="En")
@@ -1213,16 +2016,13 @@ class Civ5Replay(Civ5FileReader):
         self.l_turns_played = L("turns played", fr="tours de jeu")
         # TXT_KEY_TIME_TURN
         self.l_Turn = L("Turn",fr="Tour",de="Runde",es="Turno",it="Turno",ko="턴",pl="Tura")
-        # TXT_KEY_GAME_WON ja, ru guessed from replays
-        self.l_victory = L(" has won ",fr=" a remporté ",de=" hat den Sieg in der Kategorie ",es=" ha conseguido una ",it=" ha riportato una vittoria ",ko=" 승리를 거두었습니다",pl=" wygrywa przez Zwycięstwo ",ja="勝利を収めた",ru=" одерживает ")
         # TXT_KEY_MISC_CITY_IS_FOUNDED ; ja (が建設されました。/が創設された。) and ru guessed from replays
-        self.l_founded_str= L(" is founded.",fr=" fondée !",de=" wurde gegründet.",es="Se funda ",it=" è fondata.",ko="이(가) 건설되었습니다.",pl="Powstaje ",ja="設され",ru="Основан город")
+        self.l_founded_str = founded_message
         self.l_founded_re = L("(.*) is founded.",fr="(.*) fondée !",de="Die Stadt (.*) wurde gegründet.",es="Se funda (.*).",it="(.*) è fondata.",ko="(.*)이(가) 건설되었습니다.",pl="Powstaje (.*).",ja="(.*)が.設され.*た。",ru="Основан город (.*).")
         self.l_founded_comp = None
-        # TXT_KEY_MISC_CITY_RAZED_BY ja, ru guessed from replays
-        self.l_razed = L(" was set ablaze by ",fr=" incendié ",de=" in Brand gesteckt",es=" ha sido arrasada por el ",it=" è stata messa a ferro e fuoco dall",ko="(으)로 인해 불바다가 되었습니다",pl=" podpala ",ru=" огню город ")
-        # TXT_KEY_MISC_CITY_WAS_CAPTURED_BY ja, ru guessed from replays
-        self.l_captured = L(" was captured by ",fr=" pris ",de=" eingenommen",es=" ha capturado ",it=" è stata catturata dall",ko="에 점령당했습니다",pl=" zdobywa ",ja="に占領されました",ru=" захвачен державой ")
+        self.l_victory = victory_message
+        self.l_razed = razed_message
+        self.l_captured = captured_message
 
         # Initialize game information
         self.leader_name = None
@@ -1253,9 +2053,9 @@ class Civ5Replay(Civ5FileReader):
 
         # Initialize internal state
         self.background = None
-        self.events = []
+        self.events = Civ5EventStore(self.context)
         self.map = []
-        self.domain = []
+        self.domain = Civ5Domain()
         self.fully_read = False
         self.eof = False
         self.cities = {}
@@ -1267,52 +2067,82 @@ class Civ5Replay(Civ5FileReader):
         self.id = "replay_" + str(uuid.uuid4()).replace("-", "_")
         self.html_w = 1024
         self.html_h = 600 # will be adjusted as needed to maintain aspect ratio
+        self.keyframe_interval = 50 # turns between keyframes for the player, 0 for none
+        self.turns_per_second = 10 # initial playback speed of the player
         self.histogram_scale_w = 0
         self.histogram_scale_h = 0
 
+        # Events that have been read and processed, but not yet returned
+        # by read_event(), and the turn of the last processed event
+        self.event_queue = collections.deque()
+        self.last_turn = None
+
+        # Number of event records before the first one in self.events,
+        # which is not 0 after seek_turn()
+        self.event_base = 0
+
+        # Optional Civ5ReplayCache for the parsed replay
+        self.cache = cache
+        self.cache_key = None
+        self.cached_events = iter(())
+
         # Locale auto-guess. If locale hasn't been explictly specified via
-        # commandline option, we will read the header and iterate the events
-        # until we can guess the locale. Then we will reset the file pointer
-        # to the start of the event list, reinitialize any text strings,
-        # and clear the event list.
-        global locale
-        if debug:
-            p("Locale initially set to " + locale)
-        if locale == "auto":
-            self.read_header()
-            offset = self.r.tell()
-            if debug:
-                p("Will try to guess locale from event text.")
-            last_turn = -1
-            while locale == "auto":
-                last_map = self.map_string()
-                evt = self.read_event()
-                if evt.turn != last_turn:
-                    # p(last_map)
-                    last_turn = evt.turn
-                if ( evt.is_last_event() or (len(self.events) >= self.event_count-1) ):
-                    break
-            self.r.seek(offset)
-            if locale == "auto":
-                locale = "en"
-                if debug:
-                    p("Locale guess failed! Defaulting to English.")
-            self.l_founded_comp = re.compile(self.l_founded_re.s(), re.U)
-            self.difficulty = difficulty_strings[self.difficulty_level]
-            ms = map_sizes[self.map_size_id]
-            self.map_size = ms[0]
-            self.victory_type = victory_types.get(self.victory_type_id, "unknown")
-            self.events = []
+        # commandline option, we will read the header and the events until
+        # we can guess the locale. Anything in those events that depends on
+        # the locale is only worked out once it is known, and the events are
+        # then handed out by read_event() as usual.
+        self.context.p("Locale initially set to " + self.context.locale)
+        pending = []
+        if cache is not None:
+            self.cache_key = cache.key(self, self.context.locale)
+            cache.load(self.cache_key, self)
+        if self.context.locale == "auto" and not self.fully_read:
+            pending = self.guess_locale()
+        self.locale_found(pending)
+
+    def locale_found(self, pending=()):
+        """ Get ready to process events now that the locale is known, and process the events read while guessing it """
+        self.l_founded_comp = re.compile(self.context.s(self.l_founded_re), re.U)
+        for evt in pending:
+            self.process_event(evt)
+
+    def guess_locale(self):
+        """ Read events until the locale can be guessed from their text and queue them for read_event(). Returns the events that still need to be processed. """
+        context = self.context
+        self.read_header()
+        context.p("Will try to guess locale from event text.")
+        pending = []
+        while context.locale == "auto" and not self.fully_read:
+            evt, valid = self.read_event_record()
+            self.event_queue.append(evt)
+            if not valid:
+                continue
+            pending.append(evt)
+            if not evt.is_last_event():
+                self.guess_locale_from(evt)
+        if context.locale == "auto":
+            context.locale = "en"
+            context.p("Locale guess failed! Defaulting to English.")
+        return pending
+
+    def guess_locale_from(self, evt):
+        """ Guess the locale based upon event text. """
+        found = event_messages.classify(evt.text)
+        if found is not None:
+            self.context.locale = found[0]
+            if self.context.debug:
+                reason = { "founded": "city found", "captured": "city capture", "razed": "city razed", "victory": "victory" }[found[1]]
+                self.context.p("Locale set to " + found[0] + " based on " + reason + " event on turn " + str(evt.turn))
     
     def get_enabled_victory_types(self):
         if len(self.victory_types) == 0:
             return "None"
-        return ", ".join(map(lambda x:victory_types[x].s(), self.victory_types))
+        return ", ".join(map(lambda x:self.context.s(victory_types[x]), self.victory_types))
 
     def get_game_options(self):
         if len(self.game_options) == 0:
             return "None"
-        return ", ".join(map(lambda x:game_options[x].s(), self.game_options))
+        return ", ".join(map(lambda x:self.context.s(game_options[x]), self.game_options))
 
 
     def set_background(self, map):
@@ -1386,22 +2216,56 @@ class Civ5Replay(Civ5FileReader):
         # there seems to be a -1 here
         hd.append(self.read_int())
 
-        if debug:
-            p("I think the content starts at offset", self.r.tell())
+        self.context.p("I think the content starts at offset", self.tell())
 
         self.header_data = hd
 
+    def header_info(self):
+        """ Return what the header says as a dictionary of strings, numbers and lists, with names in the replay's locale """
+        s = self.context.s
+        return {
+            "leader_name":          self.leader_name,
+            "civ_name":             self.civ_name,
+            "civ_name_short":       self.civ_name_short,
+            "civ_name_possessive":  self.civ_name_possessive,
+            "map_script":           self.map_script,
+            "map_name":             self.map_name,
+            "map_size_id":          self.map_size_id,
+            "map_size":             s(self.map_size),
+            "w":                    self.w,
+            "h":                    self.h,
+            "difficulty_level":     self.difficulty_level,
+            "difficulty":           s(self.difficulty),
+            "victory_type_id":      self.victory_type_id,
+            "victory_type":         s(self.victory_type),
+            "game_option_ids":      self.game_options,
+            "game_options":         [ s(game_options.get(x, "unknown")) for x in self.game_options ],
+            "victory_type_ids":     self.victory_types,
+            "victory_types":        [ s(victory_types.get(x, "unknown")) for x in self.victory_types ],
+            "event_count":          self.event_count,
+        }
+
     def read_event(self):
         """ Read one event and return a Civ5ReplayEvent object """
+        if len(self.event_queue) > 0:
+            return self.event_queue.popleft()
         if self.fully_read:
-            return None
+            # events set up by set_state() are handed out from the store
+            return next(self.cached_events, None)
         self.read_header()
+        evt, valid = self.read_event_record()
+        if valid:
+            self.process_event(evt)
+        return evt
+
+    def read_event_record(self):
+        """ Decode the next event record. Returns the event and whether it's a valid part of the event list. """
         event = []
         event.append(self.read_int())
         is_last = False
         # MP: Changed the following to >= because of flexd replay 4cf2c522b878bc5e89000004
         # which somehow had one more event than expected in the list.
-        if (len(self.events)>=self.event_count-1 and event[0] not in (1,2)) or (event[0] == 0):
+        if (self.event_base+len(self.events)>=self.event_count-1 and event[0] not in (1,2)) or (event[0] == 0):
             # Special rules for the end of the replay
             event.extend(self.read_ints(2))
             event.extend([0,0,0])
@@ -1416,12 +2280,11 @@ class Civ5Replay(Civ5FileReader):
             # MP: Added self.eof check because this was infinite looping on the flexd replay 4cf2c522b878bc5e89000004
             while ( (self.read_int() != -1) and (self.eof == False) ):
                 pass
-            return Civ5ReplayEvent([1,0,0,-1,-1,0], "")
+            return Civ5ReplayEvent([1,0,0,-1,-1,0], ""), False
         else:
             event.extend(self.read_ints(5))
         event_text = self.read_string()
-        evt = Civ5ReplayEvent(event, event_text, is_last)
-        self.events.append(evt)
+        evt = Civ5ReplayEvent(event, event_text, is_last, self.events)
         if evt.is_last_event():
             self.fully_read = True
             self.final_turn = evt.turn
@@ -1434,46 +2297,35 @@ class Civ5Replay(Civ5FileReader):
             if event_end != -1:
                 print evt, event_end
             assert(event_end == -1)
-            # Guess locale based upon event text. There's probably a much shorter
-            # and more efficient way to do this....
-            global locale
-            if locale == "auto":
-                for k,v in self.l_founded_str.items():
-                    if isinstance(v,unicode):
-                        if v in evt.text:
-                            locale = k
-                            if debug:
-                                p("Locale set to " + k + " based on city found event on turn " + str(evt.turn))
-                            break
-            if locale == "auto":
-                for k,v in self.l_captured.items():
-                    if isinstance(v,unicode):
-                        if v in evt.text:
-                            locale = k
-                            if debug:
-                                p("Locale set to " + k + " based on city capture event on turn " + str(evt.turn))
-                            break
-            if locale == "auto":
-                for k,v in self.l_razed.items():
-                    if isinstance(v,unicode):
-                        if v in evt.text:
-                            locale = k
-                            if debug:
-                                p("Locale set to " + k + " based on city razed event on turn " + str(evt.turn))
-                            break
-            if locale == "auto":
-                for k,v in self.l_victory.items():
-                    if isinstance(v,unicode):
-                        if v in evt.text:
-                            locale = k
-                            if debug:
-                                p("Locale set to " + k + " based on victory event on turn " + str(evt.turn))
-                            break
+        return evt, True
+
+    def skim_events(self):
+        """ Skip ahead to the final record without turning the event records into events, and read the final record and the histogram as usual """
+        self.read_header()
+        while not self.fully_read:
+            if self.buf is not None and self.pos + 28 <= self.buf_size:
+                # an ordinary event record is its type (1 or 2), five numbers,
+                # the length of its text, the text and a -1
+                pos = self.pos
+                record_type = int_struct.unpack_from(self.buf, pos)[0]
+                length = int_struct.unpack_from(self.buf, pos + 24)[0]
+                end = pos + 28 + length
+                if record_type in (1, 2) and length >= 0 and end + 4 <= self.buf_size and int_struct.unpack_from(self.buf, end)[0] == -1:
+                    self.pos = end + 4
+                    self.event_base += 1
+                    continue
+            self.read_event_record()
+
+    def process_event(self, evt):
+        """ Update the game state with an event. This needs to know the locale. """
+        if not evt.is_last_event():
             # reset captured data if this is a new turn
-            if len(self.events)>1 and evt.turn != self.events[-2].turn:
+            if self.last_turn is not None and evt.turn != self.last_turn:
                 self.captured = {}
+            self.last_turn = evt.turn
+            found = event_messages.kinds(evt.text, self.context.locale)
             # remember victory message
-            if self.l_victory.s() in evt.text:
+            if "victory" in found:
                 self.victory_text = evt.text
             # remember city name
             if evt.event_type == 1:
@@ -1493,18 +2345,17 @@ class Civ5Replay(Civ5FileReader):
                                 self.civs.append(["Unknown Empire", "Unknown First City", "black", "white"])
                             if self.civs[evt.civ][0] == "Unknown Empire":
                                 for c in civs:
-                                    if c[1] == city:
-                                        self.civs[evt.civ] = map(unicode,c)
+                                    if self.context.s(c[1]) == city:
+                                        self.civs[evt.civ] = [ unicode(self.context.s(v)) for v in c ]
             if (evt.x, evt.y) in self.cities:
                 # we already know from earlier that this tile has a city
                 evt.city = 1
                 evt.city_name = self.cities[(evt.x, evt.y)]
-            if self.l_razed.s() in evt.text:
+            if "razed" in found:
                 # the city on this tile is being razed
                 if evt.city == 1:
                     self.razed.append((evt.x, evt.y))
-            captured = self.l_captured.s()
-            if captured in evt.text:
+            if "captured" in found:
                 # if it was being razed, it now no longer is
                 if (evt.x, evt.y) in self.razed:
                     self.razed.remove((evt.x, evt.y))
@@ -1538,50 +2389,151 @@ class Civ5Replay(Civ5FileReader):
             self.w = evt.x+1
         if evt.y >= self.h:
             self.h = evt.y+1
-        return evt
-    
+        if evt.is_last_event():
+            self.infer_razing()
+            if self.cache is not None:
+                self.cache.store(self.cache_key, self)
+
+    # instance variables that Civ5ReplayCache keeps as they are
+    state_fields = ("difficulty_level", "leader_name", "civ_name", "civ_name_short", "civ_name_possessive",
+        "map_script", "map_name", "map_size_id", "header_data", "game_options", "victory_types",
+        "victory_type_id", "event_count", "occ", "noraze", "final_turn", "final_year", "start_year",
+        "start_turn", "victory_text", "histogram_w", "histogram_h", "civs", "cities",
+        "citystates", "razed", "captured", "map", "last_turn")
+
+    def get_state(self):
+        """ Return everything read from a fully read replay as a dictionary of strings, numbers, lists and dictionaries """
+        state = dict((k, getattr(self, k)) for k in self.state_fields)
+        state["locale"] = self.context.locale
+        state["events"] = self.events.get_state()
+        state["domain"] = self.domain.get_state()
+        state["histogram"] = self.histogram.get_state()
+        return state
+
+    def set_state(self, state):
+        """ Turn a freshly opened replay into a fully read one from a dictionary returned by get_state(). read_event() then hands out the events as if they had just been read. """
+        for k in self.state_fields:
+            setattr(self, k, state[k])
+        self.context.locale = state["locale"]
+        self.events.set_state(state["events"])
+        self.domain.set_state(state["domain"])
+        self.histogram = Civ5Histogram([], array.array("i"))
+        self.histogram.set_state(state["histogram"])
+        self.difficulty = difficulty_strings[self.difficulty_level]
+        ms = map_sizes[self.map_size_id]
+        self.map_size = ms[0]
+        if self.background is None:
+            # as read_header() and process_event() would have set them
+            self.w = max([ms[1]] + [ x+1 for x in self.events.x ])
+            self.h = max([ms[2]] + [ y+1 for y in self.events.y ])
+        self.victory_type = victory_types.get(self.victory_type_id, "unknown")
+        self.fully_read = True
+        self.cached_events = iter(self.events)
+
+    def get_checkpoint(self):
+        """ Return the game state that process_event() works from as a dictionary of numbers, lists and dictionaries, see set_checkpoint() """
+        return {
+            "cities":       dict(self.cities),
+            "citystates":   dict(self.citystates),
+            "razed":        list(self.razed),
+            "captured":     dict(self.captured),
+            "civs":         [ list(c) for c in self.civs ],
+            "last_turn":    self.last_turn,
+            "victory_text": self.victory_text,
+            "map":          [ list(l) for l in self.map ],
+            "w":            self.w,
+            "h":            self.h,
+            "domain":       self.domain.latest(),
+        }
+
+    def set_checkpoint(self, state):
+        """ Replace the game state with one returned by get_checkpoint(). Ownership history from before the checkpoint is reduced to the latest state of every tile. """
+        self.cities = dict(state["cities"])
+        self.citystates = dict(state["citystates"])
+        self.razed = list(state["razed"])
+        self.captured = dict(state["captured"])
+        self.civs = [ list(c) for c in state["civs"] ]
+        self.last_turn = state["last_turn"]
+        self.victory_text = state["victory_text"]
+        self.map = [ list(l) for l in state["map"] ]
+        self.w = max(self.w, state["w"])
+        self.h = max(self.h, state["h"])
+        self.domain = Civ5Domain()
+        for x, y, turn, civ, city, city_name in state["domain"]:
+            self.domain.record(turn, x, y, civ, city, city_name)
+
+    def seek_turn(self, turn, index):
+        """ Continue reading at the first event on or after turn X, using the offsets and checkpoints of a Civ5ReplayIndex for this file instead of reading all the events before it. The events read so far are dropped, and self.events only holds the events from turn X on. """
+        self.read_header()
+        first = index.first_event(turn)
+        start, state = index.checkpoint(turn)
+
+        # start over from the checkpoint
+        self.context.locale = index.locale
+        self.l_founded_comp = re.compile(self.context.s(self.l_founded_re), re.U)
+        self.set_checkpoint(state)
+        self.events = Civ5EventStore(self.context)
+        self.event_queue.clear()
+        self.cached_events = iter(())
+        self.fully_read = False
+        self.histogram = None
+        # the replay as a whole was never read, so it mustn't be cached
+        self.cache = None
+
+        # catch up with the events between the checkpoint and turn X
+        self.event_base = start
+        self.seek(index.offsets[start])
+        while self.event_base + len(self.events) < first and not self.fully_read:
+            evt, valid = self.read_event_record()
+            if valid:
+                self.process_event(evt)
+        self.event_base += len(self.events)
+        self.events = Civ5EventStore(self.context)
+
+    def read_turns(self, first, last, index):
+        """ Generate the events from turn X to turn Y, see seek_turn() """
+        self.seek_turn(first, index)
+        while True:
+            evt = self.read_event()
+            if evt is None or evt.turn > last:
+                return
+            if evt.turn >= first:
+                yield evt
+            if evt.is_last_event():
+                return
+
     def read_histogram(self):
         """ Read the histogram data from the replay"""
         if not self.histogram is None:
             return
-        replay.read_int()  # 0
-        replay.read_int()  # time?
-        civs = replay.read_int()
-        histogram = []
-        x = 0
-        self.histogram_w = 0
-        self.histogram_h = 0
+        self.read_int()  # 0
+        self.read_int()  # time?
+        civs = self.read_int()
+        civ_info = []
+        blocks = []
         for civ in range(civs):
-            a = replay.read_int() # ?
-            b = replay.read_int() # ?
-            turns = replay.read_int() # number of 4-int data points for this civ
-            if turns > self.histogram_w:
-                self.histogram_w = turns
-            for turn in range(turns):
-                while turn >= len(histogram):
-                    histogram.append([0] * civs)
-                a = replay.read_int() # score?
-                b = replay.read_int() # ?
-                c = replay.read_int() # ?
-                d = replay.read_int() # ?
-                histogram[turn][civ] = a
-        for line in histogram:
-            score_sum = reduce(lambda a,b:a+b, line)
-            if score_sum > self.histogram_h:
-                self.histogram_h = score_sum
+            a = self.read_int() # ?
+            b = self.read_int() # ?
+            turns = max(0, self.read_int()) # number of 4-int data points for this civ
+            civ_info.append((a, b, turns))
+            # score?, ?, ?, ? for every turn
+            blocks.append(array.array("i", self.read_int_array(4*turns)))
+        histogram = Civ5Histogram(civ_info, array.array("i"))
+        for block in blocks:
+            histogram.data.extend(block)
+            histogram.data.extend(array.array("i", [0]) * (4*histogram.turns - len(block)))
+        self.histogram_w = histogram.turns
+        self.histogram_h = histogram.max_total()
         self.histogram = histogram
 
     def csv(self):
         """ Return the score histogram in csv format """
         self.read_full()
-        hist_csv = ""
-        for l in self.histogram:
-            hist_csv += ",".join(map(str,l)) + "\n"
-        return hist_csv
+        return "".join([ ",".join(map(str, row)) + "\n" for row in self.histogram.rows() ])
 
     def read_full(self):
         """ Make sure to read everything we understand """
-        if not self.fully_read:
+        if not self.fully_read or len(self.event_queue) > 0:
             self.read_header()
             while True:
                 evt = self.read_event()
@@ -1594,34 +2546,18 @@ class Civ5Replay(Civ5FileReader):
         if x < 0 or y < 0:
             return
         di = self.domain_info(turn, x, y)
-        while len(self.domain) <= y:
-            self.domain.append([])
-        ln = self.domain[y]
-        while len(ln) <= x:
-            ln.append({})
-        d = ln[x]
-        d[turn] = [ turn, di[1], -1, "" ]
+        civ = -1
+        if di is not None and di[1] is not None:
+            civ = di[1]
+        self.domain.record(turn, x, y, civ, -1, "")
 
     def domain_info(self, turn, x, y):
         """ Returns tile ownership on turn X """
-        if y < 0 or x < 0:
-            return None
-        if y >= len(self.domain):
-            return None
-        ln = self.domain[y]
-        if x >= len(ln):
-            return None
-        d = ln[x]
-        data = [None]*4
-        for a in sorted(d.keys()):
-            if a <= turn:
-                data[0] = d[a][0]
-                data[1] = d[a][1]
-                if d[a][2] != 0: 
-                    data[2] = d[a][2]
-                if d[a][3] is not None:
-                    data[3] = d[a][3]
-        return data
+        return self.domain.info(turn, x, y)
+
+    def ownership_grid(self, turn):
+        """ Returns the owner of every tile on turn X, see Civ5Domain.grid() """
+        return self.domain.grid(turn, self.w, self.h)
 
     def neighbours(self, x, y):
         xoff = y % 2
@@ -1636,45 +2572,155 @@ class Civ5Replay(Civ5FileReader):
 
     def domain_region(self, turn, x, y):
         """ Return all the tiles part of a contiguous region that contains x,y as of turn X """
-        comp = self.domain_info(turn, x, y)
-        queue = [ (x,y,comp) ]
-        region = []
-        while len(queue)>0:
-            tile = queue.pop(0)
-            if tile[2] is None:
-                continue
-            if tile[2] == {}:
-                continue
-            if tile in region:
-                continue
-            if tile[2][1] != comp[1]:
-                continue
-            region.append(tile)
+        owners, cities = self.domain.grids(turn, self.w, self.h)
+        w = self.w
+        h = self.h
+        region = set()
+        if x < 0 or y < 0 or x >= w or y >= h:
+            return Civ5Region(turn, region)
+        owner = owners[y*w+x]
+        if owner == domain_unknown:
+            return Civ5Region(turn, region)
+        seen = bytearray(w*h)
+        seen[y*w+x] = 1
+        queue = collections.deque([ (x, y) ])
+        while len(queue) > 0:
+            tile = queue.popleft()
+            region.add(tile)
             for nx, ny in self.neighbours(tile[0], tile[1]):
-                queue.append((nx, ny, self.domain_info(turn, nx, ny)))    
-        return region
+                if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                    continue
+                i = ny*w+nx
+                if seen[i] or owners[i] != owner:
+                    continue
+                seen[i] = 1
+                queue.append((nx, ny))
+        return Civ5Region(turn, region)
 
     def domain_region_intersect(self, a, b):
         """ Return the intersection of two regions, assuming the second region has the more recent data """ 
-        ret = []
-        for ra in a:
-            for rb in b:
-                if rb[0] == ra[0] and rb[1] == ra[1]:
-                    ret.append(rb)
-        return ret
+        return Civ5Region(b.turn, a.tiles & b.tiles)
 
     def domain_region_has_city(self, region):
         """ Determine whether a region as returned by domain_region() contains a city """
-        for i in region:
-            if i[2][2] == 1:
+        cities = self.domain.grids(region.turn, self.w, self.h)[1]
+        w = self.w
+        for x, y in region.tiles:
+            if cities[y*w+x] == 1:
                 return True
         return False
 
+    def infer_razing(self):
+        """ Work out which events that set a tile's owner to -1 mean that the tile was razed, and set their razed flag """
+        w = self.w
+        h = self.h
+        ev = self.events
+        events = {}
+        for i in xrange(len(ev)):
+            x = ev.x[i]
+            y = ev.y[i]
+            if ev.civ[i] == -1 and ev.turn[i] > 0 and x > -1 and y > -1 and x < w and y < h:
+                events.setdefault(ev.turn[i], []).append(i)
+        if len(events) == 0:
+            return
+
+        # all ownership changes, by turn
+        changes = {}
+        for (x, y), t in self.domain.tiles.iteritems():
+            if x >= w or y >= h:
+                continue
+            for k in range(len(t.turns)):
+                changes.setdefault(t.turns[k], []).append((y*w+x, t.civs[k], t.city_flags[k]))
+        change_turns = sorted(changes.keys())
+
+        # go through the turns in order, updating the grids as we go
+        owners = array.array("i", [domain_unknown]) * (w*h)
+        cities = array.array("b", [0]) * (w*h)
+        comp = None
+        n = 0
+        for turn in sorted(events.keys()):
+            comps = []
+            for when in (turn-1, turn):
+                if comp is None or comp.turn != when:
+                    while n < len(change_turns) and change_turns[n] <= when:
+                        for i, civ, city in changes[change_turns[n]]:
+                            owners[i] = civ
+                            cities[i] = city
+                        n += 1
+                    comp = Civ5Components(when, array.array("i", owners), array.array("b", cities), w, h)
+                comps.append(comp)
+            before, after = comps
+            known = {}
+            for i in events[turn]:
+                t = ev.y[i]*w + ev.x[i]
+                # nothing to go by if the tile had no owner before
+                if before.owners[t] == domain_unknown:
+                    continue
+                # if the tile is set to -1 when it is already -1,
+                # a good guess is that a city state razed the tile
+                if before.owners[t] == -1:
+                    ev.razed[i] = 1
+                    continue
+                # if the tile is set to -1, but at the end of the
+                # turn belongs to a contiguous -1 region that has
+                # no city in it, it must have been razed
+                la = after.label(t)
+                if la < 0 or len(after.city_tiles[la]) == 0:
+                    ev.razed[i] = 1
+                    continue
+                # if the tile is set to -1 and had an owner before, 
+                # determine the intersection between the region it 
+                # belongs to at the end of this turn and the region 
+                # it belonged to at the end of the previous turn, 
+                # and if this intersection does not contain a city, 
+                # conclude that the tile must have been razed
+                lb = before.label(t)
+                if (la, lb) not in known:
+                    known[(la, lb)] = False
+                    for c in after.city_tiles[la]:
+                        if before.label(c) == lb:
+                            known[(la, lb)] = True
+                            break
+                if not known[(la, lb)]:
+                    ev.razed[i] = 1
+
     def quotehtml(self, txt):
         return "".join(html_escape.get(x,x) for x in txt)
 
     def html(self):
         """ Returns an HTML rendering of an animated map. Only the HTML necessary to display the information is returned, no full HTML skeleton is created to facilitate embedding the map in web pages. """
+        out = StringIO.StringIO()
+        self.write_html(out, None)
+        return out.getvalue()
+
+    def write_html(self, fp, encoding="utf-8"):
+        """ Write the same HTML as html() to a file-like object, a few chunks at a time, so that the whole document never has to be kept in memory. The chunks are encoded with the given encoding, or written as unicode strings if encoding is None. """
+        self.prepare_html()
+        sections = {
+            "html_event_list":              self.html_event_list,
+            "javascript_event_list":        self.javascript_event_list,
+            "javascript_turn_to_event":     self.javascript_turn_to_event,
+            "javascript_keyframes":         self.javascript_keyframes,
+            "javascript_histogram_score":   self.javascript_histogram_score,
+            "javascript_background":        self.javascript_background,
+        }
+        # localized strings are resolved here rather than when formatting
+        values = dict((k, self.context.s(v)) for k, v in self.__dict__.iteritems())
+        buf = []
+        for template in (html_header, html_javascript, html_skeleton):
+            for literal, name in split_template(template, sections):
+                buf.append(literal % values)
+                if name is None:
+                    continue
+                for chunk in sections[name]():
+                    buf.append(chunk)
+                    if len(buf) >= html_chunk_count:
+                        write_chunks(fp, buf, encoding)
+                        buf = []
+        write_chunks(fp, buf, encoding)
+
+    def prepare_html(self):
+        """ Set up the instance variables used by the HTML templates, except for the big sections that write_html() generates as it goes """
         # make sure we know all there is to know about this replay
         self.read_full()
 
@@ -1690,25 +2736,6 @@ class Civ5Replay(Civ5FileReader):
         for v in ("leader_name", "civ_name", "map_name", "final_year", "victory_text"):
             setattr(self, v, self.quotehtml(getattr(self, v)))
 
-        # create the HTML event list for the log
-        h = "<table>"
-        for evt in self.events:
-            if evt.text != "":
-                type = "event"
-                h += """
-                    <tr>
-                        <td class="%(id)s_base_turn %(id)s_%(type)s_turn">%(l_Turn)s %(turn)s</td>
-                        <td class="%(id)s_base_text %(id)s_%(type)s_text">%(text)s</td>
-                    </tr>""" % {
-                        "id":       self.id,
-                        "type":     type,
-                        "turn":     evt.turn,
-                        "text":     self.quotehtml(evt.text),
-                        "l_Turn":   self.l_Turn,
-                    }
-        h += "</table>"
-        self.html_event_list = h
-
         # make game options available to html
         h = ""
         if len(self.game_options) > 0:
@@ -1719,7 +2746,7 @@ class Civ5Replay(Civ5FileReader):
                 if vt < 0:
                     continue
                 if not vt in self.victory_types:
-                    dvt.append(victory_types[vt].s())
+                    dvt.append(self.context.s(victory_types[vt]))
             if len(h) > 0:
                 h += " | "
             h += "/".join(map(lambda x: '<span class="%s_disabled_option">%s</span>' % (self.id, x,), dvt))
@@ -1737,12 +2764,42 @@ class Civ5Replay(Civ5FileReader):
         j += "]"
         self.javascript_civs = j
 
-        # create the javascript event list for drawing
-        last_event = None
-        j = "[\n"
-        for evt in self.events:
-            if evt.x > -1 and evt.y > -1:
-                if evt.civ == -1:
+    def html_event_list(self):
+        """ Generate the HTML event list for the log """
+        ev = self.events
+        l_Turn = self.context.s(self.l_Turn)
+        yield "<table>"
+        for i in xrange(len(ev)):
+            text = ev.strings[ev.text[i]]
+            if text != "":
+                type = "event"
+                yield """
+                    <tr>
+                        <td class="%(id)s_base_turn %(id)s_%(type)s_turn">%(l_Turn)s %(turn)s</td>
+                        <td class="%(id)s_base_text %(id)s_%(type)s_text">%(text)s</td>
+                    </tr>""" % {
+                        "id":       self.id,
+                        "type":     type,
+                        "turn":     ev.turn[i],
+                        "text":     self.quotehtml(text),
+                        "l_Turn":   l_Turn,
+                    }
+        yield "</table>"
+
+    def javascript_event_list(self):
+        """ Generate the compact javascript event list for drawing. Colours and strings are stored once and referenced by index, the numeric columns are packed into typed arrays. """
+        ev = self.events
+        palette = {"": 0}
+        strings = {"": 0}
+        columns = dict((name, array.array("i")) for name in ("turn", "x", "y", "bg", "fg", "text", "city", "city_name"))
+        names = {}
+        for i in xrange(len(ev)):
+            x = ev.x[i]
+            y = ev.y[i]
+            civ = ev.civ[i]
+            text = ev.strings[ev.text[i]]
+            if x > -1 and y > -1:
+                if civ == -1:
                     # -1 is either a tile flipping to a city state,
                     # or a tile losing its owner (e.g. due to razing)
                     # for now, razed tiles are shown using the same
@@ -1751,99 +2808,112 @@ class Civ5Replay(Civ5FileReader):
                     # circle thingy will disappear
                     fg = citystate_color[0]
                     bg = citystate_color[1]
-                    if evt.turn > 0:
-                        # if the tile is set to -1 when it is already -1,
-                        # a good guess is that a city state razed the tile
-                        d = self.domain_info(evt.turn-1, evt.x, evt.y)
-                        if d is not None and d[1] is not None:
-                            if d[1] == -1:
-                                fg = "transparent"
-                                bg = "transparent"
-                            # if the tile is set to -1, but at the end of the
-                            # turn belongs to a contiguous -1 region that has
-                            # no city in it, it must have been razed
-                            r = self.domain_region(evt.turn, evt.x, evt.y)
-                            if not self.domain_region_has_city(r):
-                                fg = "transparent"
-                                bg = "transparent"
-                            else:
-                                # if the tile is set to -1 and had an owner before, 
-                                # determine the intersection between the region it 
-                                # belongs to at the end of this turn and the region 
-                                # it belonged to at the end of the previous turn, 
-                                # and if this intersection does not contain a city, 
-                                # conclude that the tile must have been razed
-                                r_before = self.domain_region(evt.turn-1, evt.x, evt.y)
-                                r_i = self.domain_region_intersect(r_before, r)
-                                if not self.domain_region_has_city(r_i):
-                                    fg = "transparent"
-                                    bg = "transparent"
-                elif evt.civ >= 0:
+                    if ev.razed[i]:
+                        fg = "transparent"
+                        bg = "transparent"
+                elif civ >= 0:
                     # a tile is being flipped to a new owner
                     #MP debug
-                    #p("city flip event for civ " + str(evt.civ))
-                    fg = self.civs[evt.civ][2]
-                    bg = self.civs[evt.civ][3]
+                    #p("city flip event for civ " + str(civ))
+                    fg = self.civs[civ][2]
+                    bg = self.civs[civ][3]
                 else:
                     bg = "white"
                     fg = "black"
-                cn = evt.city_name
+                cn = ev.get_string(ev.city_name[i])
                 if cn is None:
                     cn = ""
-                e = ( evt.turn, evt.x, self.h-evt.y-1, bg, fg, self.quotehtml(evt.text), evt.city, self.quotehtml(cn) )
-                j += '    [ %d, %d, %d, "%s", "%s", "%s", %d, "%s" ],\n' % e
-                last_event = e
-            elif evt.text != "":
-                e = ( evt.turn, -1, -1, "", "", self.quotehtml(evt.text), 0, "" )
-                j += '    [ %d, %d, %d, "%s", "%s", "%s", %d, "%s" ],\n' % e
-                last_event = e
-        j += "]"
-        self.javascript_event_list = j
-
-        # map event list index to turn number for javascript
-        j = "["
+                y = self.h-y-1
+                city = ev.city[i]
+                # a city event without a name keeps the name the tile had
+                if city == 1 and cn == "" and (x, y) in names:
+                    cn = names[(x, y)]
+                names[(x, y)] = cn
+            else:
+                # events without a location only carry a text; events
+                # without a text are kept as well so that the indices
+                # match javascript_turn_to_event()
+                x, y, bg, fg, city, cn = -1, -1, "", "", 0, ""
+            columns["turn"].append(ev.turn[i])
+            columns["x"].append(x)
+            columns["y"].append(y)
+            columns["bg"].append(palette.setdefault(bg, len(palette)))
+            columns["fg"].append(palette.setdefault(fg, len(palette)))
+            columns["text"].append(strings.setdefault(text, len(strings)))
+            columns["city"].append(city)
+            columns["city_name"].append(strings.setdefault(cn, len(strings)))
+
+        yield "{\n    \"palette\": [ "
+        for colour in sorted(palette, key=palette.get):
+            yield '"%s", ' % (colour,)
+        yield "],\n    \"strings\": [\n"
+        for text in sorted(strings, key=strings.get):
+            yield '        "%s",\n' % (self.quotehtml(text),)
+        yield "    ],\n    \"columns\": {\n"
+        for name in ("turn", "x", "y", "bg", "fg", "text", "city", "city_name"):
+            yield '        "%s": [ "%s", "%s" ],\n' % ((name,) + javascript_column(columns[name]))
+            del columns[name]
+        yield "    }\n}"
+
+    def javascript_turn_to_event(self):
+        """ Generate the javascript list mapping turn numbers to event list indices """
+        yield "["
         turn = 0
         ec = 0
-        for evt in self.events:
-            while evt.turn >= turn:
-                j += "%d, " % (ec,)
+        for t in self.events.turn:
+            while t >= turn:
+                yield "%d, " % (ec,)
                 turn += 1
             ec += 1
-        j += "]"
-        self.javascript_turn_to_event = j
-
-        # create the javascript histogram data
-        j = "[\n"
-        for line in self.histogram:
-            j += "    %s,\n" % (str(line),) 
-        j += "]"
-        self.javascript_histogram_score = j
-
-        # create the javascript background map data
-        j = "[\n"
+        yield "]"
+
+    def javascript_keyframes(self):
+        """ Generate the ownership keyframes for the javascript player, one every keyframe_interval turns. A keyframe holds the indices of the events that set the state of every owned tile before its turn, so that the player can start drawing from there instead of from the first event. """
+        yield "["
+        interval = self.keyframe_interval
+        if interval > 0:
+            ev = self.events
+            last = {}
+            turn = interval
+            for i in xrange(len(ev)):
+                while ev.turn[i] >= turn:
+                    owned = sorted(last.itervalues())
+                    deltas = [ b - a for a, b in zip([0] + owned, owned) ]
+                    yield '\n    [%d, "%s", "%s"],' % ((turn,) + javascript_column(deltas))
+                    turn += interval
+                if ev.x[i] > -1 and ev.y[i] > -1:
+                    last[(ev.x[i], ev.y[i])] = i
+        yield "]"
+
+    def javascript_histogram_score(self):
+        """ Generate the javascript histogram data """
+        yield "[\n"
+        for row in self.histogram.rows():
+            yield "    [%s],\n" % (", ".join(map(str, row)),)
+        yield "]"
+
+    def javascript_background(self):
+        """ Generate the javascript background map data """
+        yield "[\n"
         if self.background is not None:
-            for line in self.background.map:
-                j += "    ["
-                for tile in line:
-                    hf = tile[3]
-                    if tile[2] == "FEATURE_ICE":
+            bg = self.background
+            colors = [ map_colors.get(t,"") for t in bg.terrains ]
+            for y in range(bg.h):
+                j = "    ["
+                for i in range(y*bg.w, (y+1)*bg.w):
+                    hf = bg.tile_hill[i]
+                    if bg.get_feature(bg.tile_feature[i]) == "FEATURE_ICE":
                         hf = -1;
-                    rf = tile[4]
-                    j += '["%s",%d,%d],' % (map_colors.get(tile[0],""),hf,rf)
-                j += "],\n"
-        j += "]"
-        self.javascript_background = j
-        
-        # assemble the HTML
-        ret = html_header % self.__dict__
-        ret += html_javascript % self.__dict__
-        ret += html_skeleton % self.__dict__
-        return ret
+                    rf = bg.tile_river[i]
+                    j += '["%s",%d,%d],' % (colors[bg.tile_terrain[i]],hf,rf)
+                yield j + "],\n"
+        yield "]"
 
     def leader_info(self):
         """ Return a human-readable short description including the leader name, civilization name and map name """
         self.read_header()    
-        return L("%s of the %s (%s, %s, %s)", fr="%s de l'%s (%s, %s, %s)") % (self.leader_name, self.civ_name, self.difficulty, self.map_size, self.map_name)
+        s = self.context.s
+        return s(L("%s of the %s (%s, %s, %s)", fr="%s de l'%s (%s, %s, %s)")) % (self.leader_name, self.civ_name, s(self.difficulty), s(self.map_size), self.map_name)
 
     def map_string(self):
         """ Make a half-assed attempt at rendering the map as of the last event read as a human-readable string """
@@ -1852,19 +2922,890 @@ class Civ5Replay(Civ5FileReader):
         for line in reversed(self.map):
             if indent:
                 ret += " "
-            for field in line:
-                t = "  "
-                if field > 0:
-                    t = "%d%d" % (field, field)
-                elif field == -2:
-                    t = "##"
-                elif field == -1:
-                    t = "**"
-                ret += t
+            ret += "".join([ map_tile_text(field) for field in line ])
             ret += "\n"
             indent = not indent
         return ret
 
+def map_tile_text(field):
+    """ Return the text for a tile of Civ5Replay.map in map_string() """
+    if field > 0:
+        return "%d%d" % (field, field)
+    elif field == -2:
+        return "##"
+    elif field == -1:
+        return "**"
+    return "  "
+
+class Civ5MapText(object):
+    """ Keeps the text of Civ5Replay.map_string() up to date as events change the map. Only changed tiles are turned into text again and only rows with changed tiles are joined again, so the map can be written out after every turn without rendering all of it every time. """
+
+    def __init__(self):
+        self.map = []       # as Civ5Replay.map
+        self.cells = []     # the text of every tile, by row
+        self.lines = []     # the text of every row, None if it has changed
+
+    def update(self, evt):
+        """ Apply the map change of an event """
+        if evt.x < 0 or evt.y < 0:
+            return
+        evt.update_map(self.map)
+        while len(self.cells) < len(self.map):
+            self.cells.append([])
+            self.lines.append("")
+        row = self.map[evt.y]
+        cells = self.cells[evt.y]
+        while len(cells) < len(row):
+            cells.append(map_tile_text(0))
+        cells[evt.x] = map_tile_text(row[evt.x])
+        self.lines[evt.y] = None
+
+    def text(self):
+        """ Return the map as map_string() would """
+        lines = self.lines
+        for y in xrange(len(lines)):
+            if lines[y] is None:
+                lines[y] = "".join(self.cells[y])
+        indent = len(lines)%2 == 0
+        ret = []
+        for line in reversed(lines):
+            if indent:
+                ret.append(" ")
+            ret.append(line)
+            ret.append("\n")
+            indent = not indent
+        return "".join(ret)
+
+class Civ5ReplayParser(object):
+    """ Parses a replay from bytes pushed into it with feed(), so that parsing can start while the replay is still arriving, e.g. as an upload. Every header or record is only decoded once all of its bytes are there; until then the bytes are kept for the next feed(). When it's done, replay is a fully read Civ5Replay. """
+
+    def __init__(self, context=None):
+        if context is None:
+            context = Civ5Context(locale, debug)
+        self.context = context
+        # the locale is guessed here rather than by the replay, which would
+        # read ahead to do it
+        self.guessing = context.locale == "auto"
+        if self.guessing:
+            context.locale = "en"
+        self.replay = Civ5Replay(StringIO.StringIO(""), context=context)
+        if self.guessing:
+            context.locale = "auto"
+        self.data = ""
+        self.pending = []   # events read while guessing the locale
+
+    def feed(self, data):
+        """ Add the next bytes of the replay. Returns a list of what they complete, in the order of the replay: a ("header", dictionary) tuple as in Civ5Replay.header_info(), ("event", Civ5ReplayEvent) tuples and finally a ("histogram", Civ5Histogram) tuple. While the locale is being guessed, events are held back until it's known, and the names in the header are English. """
+        replay = self.replay
+        # drop what has been decoded, keeping the start of the next record
+        self.data = self.data[replay.pos:] + data
+        replay.buf = self.data
+        replay.pos = 0
+        out = []
+        while not replay.fully_read:
+            try:
+                end = self.next_end()
+            except struct.error:
+                break
+            out.extend(self.step(end))
+        return out
+
+    def close(self):
+        """ Tell the parser that there are no more bytes, and return what the remaining ones complete, decoded the way Civ5Replay decodes a file that ends there """
+        out = []
+        while not self.replay.fully_read:
+            out.extend(self.step(len(self.data)))
+        return out
+
+    def step(self, end):
+        """ Decode the header or record that ends at offset end, and return what it completes """
+        replay = self.replay
+        replay.buf_size = end
+        if replay.leader_name is None:
+            replay.read_header()
+            return [("header", replay.header_info())]
+        evt, valid = replay.read_event_record()
+        if not valid:
+            return []
+        out = []
+        if self.guessing:
+            self.pending.append(evt)
+            if not evt.is_last_event():
+                replay.guess_locale_from(evt)
+                if self.context.locale == "auto":
+                    return out
+            if self.context.locale == "auto":
+                self.context.locale = "en"
+                self.context.p("Locale guess failed! Defaulting to English.")
+            self.guessing = False
+            replay.locale_found(self.pending)
+            out.extend(("event", e) for e in self.pending)
+            self.pending = []
+        else:
+            replay.process_event(evt)
+            out.append(("event", evt))
+        if evt.is_last_event():
+            out.append(("histogram", replay.histogram))
+        return out
+
+    # Framing: find where the header or record at the read position ends
+    # without decoding it. These follow read_header(), read_event_record()
+    # and read_histogram(), and raise struct.error if the end hasn't
+    # arrived yet.
+
+    def int_at(self, pos):
+        return int_struct.unpack_from(self.data, pos)[0]
+
+    def skip(self, pos, size):
+        if pos + size > len(self.data):
+            raise struct.error("incomplete record")
+        return pos + size
+
+    def skip_string(self, pos):
+        size = self.int_at(pos)
+        if size < 0:
+            # read_bytes() takes this as "everything that's left"
+            raise struct.error("string length %d" % (size,))
+        return self.skip(pos + 4, size)
+
+    def skip_ints(self, pos, esize=1):
+        return self.skip(pos + 4, 4 * esize * max(0, self.int_at(pos)))
+
+    def next_end(self):
+        """ Return the offset just past the header or record at the read position """
+        replay = self.replay
+        pos = replay.pos
+        if replay.leader_name is None:
+            pos = self.skip(pos, 12)
+            for i in range(5):
+                pos = self.skip_string(pos)
+            pos = self.skip_ints(self.skip_ints(self.skip(pos, 20)))
+            return self.skip(self.skip_ints(self.skip(pos, 16), 2), 4)
+        record_type = self.int_at(pos)
+        if (replay.event_base+len(replay.events)>=replay.event_count-1 and record_type not in (1,2)) or (record_type == 0):
+            # the final record, with the histogram after it
+            pos = self.skip_string(self.skip(pos, 12))
+            civs = self.int_at(self.skip(pos, 8))
+            pos = self.skip(pos, 12)
+            for civ in range(civs):
+                pos = self.skip(pos + 12, 16 * max(0, self.int_at(pos + 8)))
+            return pos
+        elif record_type == -1:
+            return self.skip(self.skip_string(self.skip(pos, 8)), 4)
+        elif record_type not in (0,1,2):
+            # skipped up to the next -1
+            pos += 4
+            while self.int_at(pos) != -1:
+                pos += 4
+            return pos + 4
+        return self.skip(self.skip_string(self.skip(pos, 24)), 4)
+
+# Bump this whenever a change to the parser changes what it makes of a replay
+# file, so that Civ5ReplayCache doesn't hand out stale results.
+parser_version = 2
+
+# marks the start of a Civ5ReplayCache file
+cache_magic = "Civ5ReplayCache\n"
+
+class Civ5ReplayCache(object):
+    """ Keeps parsed replays in a directory, keyed by a hash of the replay file, the parser version and the locale. The least recently used entries are removed when the directory grows beyond max_size bytes. """
+
+    def __init__(self, directory, max_size=256*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, replay, locale):
+        """ Return the cache key for a replay that hasn't been read from yet. The whole file has to be hashed, so an unbuffered replay is switched to buffered mode rather than reading its input twice (which can't be done with pipes or sockets). """
+        h = hashlib.sha1("%d %s\n" % (parser_version, locale))
+        if replay.buf is None:
+            replay.load_buffer()
+            replay.buffered = True
+        h.update(replay.buf[replay.pos:])
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".c5r")
+
+    def load(self, key, replay):
+        """ Set up a freshly opened replay from the cache. Returns False if there is no usable cache entry. """
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+            data = f.read()
+            f.close()
+        except EnvironmentError:
+            return False
+        if not data.startswith(cache_magic):
+            return False
+        try:
+            state = marshal.loads(data[len(cache_magic):])
+        except (EOFError, ValueError, TypeError):
+            return False
+        replay.set_state(state)
+        # mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            pass
+        return True
+
+    def store(self, key, replay):
+        """ Add a fully read replay to the cache. Failing to do so (an unwritable directory, a full disk, ...) is logged and otherwise ignored, the cache is only there to save time. """
+        path = self.path(key)
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(".tmp", key, self.directory)
+            f = os.fdopen(fd, "wb")
+            try:
+                f.write(cache_magic)
+                f.write(marshal.dumps(replay.get_state()))
+            finally:
+                f.close()
+            try:
+                os.rename(tmp, path)
+            except EnvironmentError:
+                # someone else stored it first (and this is Windows)
+                os.remove(tmp)
+            tmp = None
+            self.evict(path)
+        except EnvironmentError, e:
+            replay.context.p("Could not store the replay in the cache:", e)
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except EnvironmentError:
+                    pass
+
+    def evict(self, keep=None):
+        """ Remove the least recently used entries until the cache fits in max_size, except for the entry at path keep """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".c5r"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            total += st.st_size
+            if path != keep:
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                continue
+            total -= size
+
+def read_metadata(input, locale="en", final=False):
+    """ Read just the header of a replay and return what it says as a dictionary of strings, numbers and lists. The events aren't looked at, so the locale isn't guessed; names are given in the locale asked for. If final is True, the event records are skimmed for the final turn and year as well. """
+    replay = Civ5Replay(input, context=Civ5Context(locale, False))
+    replay.read_header()
+    record = replay.header_info()
+    if final:
+        replay.skim_events()
+        record["final_turn"] = replay.final_turn
+        record["final_year"] = replay.final_year
+    return record
+
+# columns of the Civ5Catalogue replays table, other than path, mtime, size and error,
+# with their types; game options and victory types are comma separated ids
+catalogue_columns = [
+    ("leader_name", "TEXT"),
+    ("civ_name", "TEXT"),
+    ("civ_name_short", "TEXT"),
+    ("civ_name_possessive", "TEXT"),
+    ("map_script", "TEXT"),
+    ("map_name", "TEXT"),
+    ("map_size_id", "INTEGER"),
+    ("difficulty_level", "INTEGER"),
+    ("victory_type_id", "INTEGER"),
+    ("game_options", "TEXT"),
+    ("victory_types", "TEXT"),
+    ("event_count", "INTEGER"),
+    ("final_turn", "INTEGER"),
+    ("final_year", "TEXT"),
+]
+
+class Civ5Catalogue(object):
+    """ A SQLite database of the header data of a collection of replays, see read_metadata(). Files are only read again when their mtime or size changes. """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        # paths are kept as the bytes they are on disk, text comes back as utf-8
+        self.db.text_factory = str
+        columns = "".join([ ", %s %s" % c for c in catalogue_columns ])
+        self.db.execute("CREATE TABLE IF NOT EXISTS replays (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, error TEXT%s)" % (columns,))
+        self.db.execute("CREATE TABLE IF NOT EXISTS replay_options (path TEXT, option INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS replays_game ON replays (difficulty_level, victory_type_id, map_size_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS replays_leader ON replays (leader_name)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS replay_options_option ON replay_options (option, path)")
+        self.db.commit()
+
+    def update(self, files):
+        """ Add new and changed replay files to the catalogue and remove files that no longer exist. Returns the number of files added or changed, unchanged, removed and failed. """
+        known = dict((row[0], (row[1], row[2])) for row in self.db.execute("SELECT path, mtime, size FROM replays"))
+        changed = unchanged = removed = failed = 0
+        for f in files:
+            f = os.path.abspath(f)
+            try:
+                st = os.stat(f)
+            except OSError, e:
+                # gone or unreadable, there's nothing to record for it
+                p(f, "%s: %s" % (e.__class__.__name__, e))
+                failed += 1
+                continue
+            if known.get(f) == (st.st_mtime, st.st_size):
+                unchanged += 1
+                continue
+            error = None
+            try:
+                m = read_metadata(f, final=True)
+                m["game_options"] = ",".join(map(str, m["game_option_ids"]))
+                m["victory_types"] = ",".join(map(str, m["victory_type_ids"]))
+                values = [ m[c] for c, t in catalogue_columns ]
+            except Exception, e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+                m = None
+                values = [None] * len(catalogue_columns)
+                failed += 1
+            self.db.execute("INSERT OR REPLACE INTO replays (path, mtime, size, error%s) VALUES (?, ?, ?, ?%s)" % (
+                "".join([ ", " + c for c, t in catalogue_columns ]), ", ?" * len(catalogue_columns)),
+                [f, st.st_mtime, st.st_size, error] + values)
+            self.db.execute("DELETE FROM replay_options WHERE path = ?", (f,))
+            if m is not None:
+                self.db.executemany("INSERT INTO replay_options (path, option) VALUES (?, ?)", [ (f, o) for o in m["game_option_ids"] ])
+                changed += 1
+        for f in known:
+            if not os.path.exists(f):
+                self.db.execute("DELETE FROM replays WHERE path = ?", (f,))
+                self.db.execute("DELETE FROM replay_options WHERE path = ?", (f,))
+                removed += 1
+        self.db.commit()
+        return changed, unchanged, removed, failed
+
+    def find(self, options=(), **criteria):
+        """ Return the paths of the replays whose columns have the given values and that were played with all of the given game option ids, e.g. find(difficulty_level=7, victory_type_id=2, map_size_id=5) """
+        where = [ "error IS NULL" ]
+        args = []
+        for k, v in sorted(criteria.items()):
+            if k not in dict(catalogue_columns):
+                raise ValueError("unknown catalogue column %s" % (k,))
+            where.append("%s = ?" % (k,))
+            args.append(v)
+        for o in options:
+            where.append("path IN (SELECT path FROM replay_options WHERE option = ?)")
+            args.append(o)
+        return [ row[0] for row in self.db.execute("SELECT path FROM replays WHERE %s ORDER BY path" % (" AND ".join(where),), args) ]
+
+    def close(self):
+        self.db.close()
+
+class Civ5ReplayIndex(object):
+    """ The byte offsets of the event records in a replay file, the first event of every turn, and checkpoints of the game state every interval turns, for Civ5Replay.seek_turn(). An index can be kept in a sidecar file next to the replay. """
+
+    def __init__(self):
+        self.size = None
+        self.mtime = None
+        self.locale = None
+        self.interval = None
+        # offset and turn of every event record that ends up in Civ5Replay.events,
+        # records that read_event_record() skips as invalid are left out
+        self.offsets = array.array("i")
+        self.turns = array.array("i")
+        # first turn number and event index of every run of events with the same turn
+        self.turn_starts = array.array("i")
+        self.turn_events = array.array("i")
+        # (event index, Civ5Replay.get_checkpoint()) by turn, for every interval turns
+        self.checkpoints = {}
+
+    def build(self, path, interval=50, locale="auto"):
+        """ Index a replay file. The file is read once, working out the game state as each event record is read, and only the events of the last few turns are kept in memory. """
+        st = os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.interval = interval
+
+        r = Civ5Replay(path, context=Civ5Context("en", False))
+        r.read_header()
+        # events read while the locale is guessed from their texts like
+        # Civ5Replay.guess_locale() does, they are processed once it's known
+        pending = []
+        processed = 0
+        next_turn = 0
+        while not r.fully_read:
+            offset = r.tell()
+            evt, valid = r.read_event_record()
+            if not valid:
+                continue
+            self.offsets.append(offset)
+            self.turns.append(evt.turn)
+            if len(self.turn_starts) == 0 or evt.turn != self.turn_starts[-1]:
+                self.turn_starts.append(evt.turn)
+                self.turn_events.append(len(self.turns) - 1)
+
+            pending.append(evt)
+            if locale == "auto":
+                found = None
+                if not evt.is_last_event():
+                    found = event_messages.classify(evt.text)
+                if found is not None:
+                    locale = found[0]
+                elif not r.fully_read:
+                    continue
+                else:
+                    locale = "en"
+            if r.context.locale != locale:
+                r.context.locale = locale
+                r.locale_found()
+
+            # work out the game state, taking a checkpoint before the
+            # first event of every interval turns
+            for evt in pending:
+                while evt.turn >= next_turn:
+                    self.checkpoints[next_turn] = (processed, r.get_checkpoint())
+                    next_turn += interval
+                if not evt.is_last_event():
+                    r.process_event(evt)
+                processed += 1
+            pending = []
+            if len(r.events) >= 1024:
+                # drop the events, the state they led to is all that's needed
+                r.event_base += len(r.events)
+                r.events = Civ5EventStore(r.context)
+        self.locale = locale
+
+    def first_event(self, turn):
+        """ Return the index of the first event on or after turn X """
+        i = bisect.bisect_left(self.turn_starts, turn)
+        if i >= len(self.turn_events):
+            return len(self.turns) - 1
+        return self.turn_events[i]
+
+    def checkpoint(self, turn):
+        """ Return the event index and game state of the last checkpoint on or before turn X """
+        turn = max(0, min(turn, max(self.checkpoints)))
+        turn -= turn % self.interval
+        while turn not in self.checkpoints:
+            turn -= self.interval
+        return self.checkpoints[turn]
+
+    def matches(self, path):
+        """ Return True if this is an index of the file as it is now """
+        st = os.stat(path)
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    def save(self, path):
+        """ Write the index to a file """
+        state = {
+            "version":      parser_version,
+            "size":         self.size,
+            "mtime":        self.mtime,
+            "locale":       self.locale,
+            "interval":     self.interval,
+            "offsets":      self.offsets.tostring(),
+            "turns":        self.turns.tostring(),
+            "turn_starts":  self.turn_starts.tostring(),
+            "turn_events":  self.turn_events.tostring(),
+            "checkpoints":  self.checkpoints,
+        }
+        f = open(path, "wb")
+        f.write(index_magic)
+        f.write(marshal.dumps(state))
+        f.close()
+
+    def load(self, path):
+        """ Read an index written by save(). Returns False if the file isn't a usable index. """
+        try:
+            f = open(path, "rb")
+            data = f.read()
+            f.close()
+        except EnvironmentError:
+            return False
+        if not data.startswith(index_magic):
+            return False
+        try:
+            state = marshal.loads(data[len(index_magic):])
+        except (EOFError, ValueError, TypeError):
+            return False
+        if state.get("version") != parser_version:
+            return False
+        for k in ("size", "mtime", "locale", "interval", "checkpoints"):
+            setattr(self, k, state[k])
+        for k in ("offsets", "turns", "turn_starts", "turn_events"):
+            a = array.array(getattr(self, k).typecode)
+            a.fromstring(state[k])
+            setattr(self, k, a)
+        return True
+
+# marks the start of a Civ5ReplayIndex sidecar file
+index_magic = "Civ5ReplayIndex\n"
+
+def replay_index(path, interval=50, locale="auto", sidecar=True):
+    """ Return a Civ5ReplayIndex for a replay file. If sidecar is True, the index is read from the file name + ".idx" if that is up to date, and written there otherwise. """
+    index = Civ5ReplayIndex()
+    idx_path = path + ".idx"
+    if sidecar and index.load(idx_path) and index.matches(path) and index.interval == interval and locale in ("auto", index.locale):
+        return index
+    index = Civ5ReplayIndex()
+    index.build(path, interval, locale)
+    if sidecar:
+        index.save(idx_path)
+    return index
+
+def replay_files(args):
+    """ Expand a list of files, directories and glob patterns into a sorted list of replay files """
+    return [ path for path, name in replay_names(args) ]
+
+def replay_names(args):
+    """ Expand a list of files, directories and glob patterns into a sorted list of (replay file, output name) tuples. The output name is the file name without its extension; for replays found in a directory, it's their path from the parent of that directory, so that replays of the same name in different directories have different output names. Any names that still clash get a number appended. """
+    names = {}
+    for arg in args:
+        if os.path.isdir(arg):
+            parent = os.path.dirname(os.path.normpath(arg))
+            for root, dirs, files in os.walk(arg):
+                for n in files:
+                    if n.endswith(".Civ5Replay"):
+                        path = os.path.join(root, n)
+                        names.setdefault(path, os.path.relpath(path, parent))
+        elif glob.has_magic(arg):
+            for path in glob.glob(arg):
+                names.setdefault(path, os.path.basename(path))
+        else:
+            names.setdefault(arg, os.path.basename(arg))
+    result = []
+    taken = set()
+    for path in sorted(names):
+        base = name = names[path].rsplit(".", 1)[0]
+        i = 1
+        while os.path.normcase(name) in taken:
+            i += 1
+            name = "%s_%d" % (base, i)
+        taken.add(os.path.normcase(name))
+        result.append((path, name))
+    return result
+
+def output_file(directory, name, extension):
+    """ Return the path of an output file for a replay in batch mode, creating its directory if needed, or None if it already exists """
+    path = os.path.join(directory, name + extension)
+    if os.path.exists(path):
+        p(path, "already exists, NOT overwriting!")
+        return None
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        # it's there already, maybe made by another worker
+        pass
+    return path
+
+def convert_replay(job):
+    """ Write the HTML and CSV output for one replay in batch mode. job is a tuple of the replay file name, its output name from replay_names() and a dictionary of settings. Returns the file name, the number of events, the time taken, an error message or None and, if settings["profile"] is set, the report() of a Civ5Profile of the conversion. """
+    path, name, settings = job
+    start = time.time()
+    profile = None
+    if settings["profile"]:
+        profile = Civ5Profile()
+    try:
+        cache = None
+        if settings["cache"]:
+            cache = Civ5ReplayCache(settings["cache"], settings["cache_size"])
+        context = Civ5Context(settings["locale"], settings["debug"], profile)
+        replay = Civ5Replay(path, cache=cache, context=context)
+        if settings["width"]:
+            replay.html_w = settings["width"]
+        base = path.rsplit(".", 1)[0]
+        map_file = settings["map"]
+        if map_file is None and os.path.exists(base + ".Civ5Map"):
+            map_file = base + ".Civ5Map"
+        if map_file:
+            replay.set_background(Civ5Map(map_file, context=context))
+        replay.read_full()
+
+        if settings["html"]:
+            html_file = output_file(settings["html"], name, ".html")
+        else:
+            html_file = base + ".html"
+            if os.path.exists(html_file):
+                p(html_file, "already exists, NOT overwriting!")
+                html_file = None
+        if html_file:
+            html = open(html_file, "wb")
+            replay.write_html(html)
+            html.close()
+        csv_file = settings["csv"] and output_file(settings["csv"], name, ".csv")
+        if csv_file:
+            csv = codecs.open(csv_file, "w", "utf-8")
+            csv.write(replay.csv())
+            csv.close()
+        return (path, len(replay.events), time.time() - start, None, profile and profile.report())
+    except Exception, e:
+        return (path, 0, time.time() - start, "%s: %s" % (e.__class__.__name__, e), profile and profile.report())
+
+def batch(files, settings, jobs, profile=None):
+    """ Convert many replays on a pool of jobs worker processes, see convert_replay(). files is a list of (replay file, output name) tuples from replay_names(). Prints failures as they happen and a throughput summary at the end. The workers' profiles are merged into profile if one is given. Returns the number of failed files. """
+    start = time.time()
+    settings = dict(settings, profile=profile is not None)
+    work = [ (f, name, settings) for f, name in files ]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(convert_replay, work)
+    else:
+        pool = None
+        results = (convert_replay(w) for w in work)
+    done = []
+    failed = 0
+    for path, events, seconds, error, report in results:
+        if report is not None:
+            profile.merge(report)
+        if error is not None:
+            failed += 1
+            sys.stderr.write("%s failed: %s\n" % (path, error))
+        else:
+            done.append((seconds, path, events))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = max(time.time() - start, 1e-6)
+    events = sum(e for s, f, e in done)
+    print "Converted %d of %d files in %.1fs using %d jobs: %.1f files/s, %.0f events/s" % (
+        len(done), len(files), elapsed, jobs, len(done) / elapsed, events / elapsed)
+    done.sort(reverse=True)
+    if len(done) > 0:
+        print "Slowest files:"
+        for seconds, path, events in done[:5]:
+            print "  %7.2fs %7d events  %s" % (seconds, events, path)
+    return failed
+
+def render_timeout(signum, frame):
+    raise multiprocessing.TimeoutError("rendering took too long")
+
+def render_replay(job):
+    """ Render an uploaded replay on a service worker. job is a tuple of the replay data, the map data or None, the output format ("html" or "csv") and a dictionary of settings. Returns an HTTP status code and the output or an error message. Rendering is stopped after settings["timeout"] seconds where the platform has SIGALRM. """
+    replay_data, map_data, format, settings = job
+    alarm = hasattr(signal, "SIGALRM")
+    if alarm:
+        signal.signal(signal.SIGALRM, render_timeout)
+        signal.alarm(settings["timeout"])
+    try:
+        cache = None
+        if settings["cache"]:
+            cache = Civ5ReplayCache(settings["cache"], settings["cache_size"])
+        context = Civ5Context(settings["locale"], False)
+        replay = Civ5Replay(StringIO.StringIO(replay_data), cache=cache, context=context)
+        if settings["width"]:
+            replay.html_w = settings["width"]
+        if map_data:
+            replay.set_background(Civ5Map(StringIO.StringIO(map_data), context=context))
+        if format == "csv":
+            return (200, replay.csv().encode("utf-8"))
+        out = StringIO.StringIO()
+        replay.write_html(out)
+        return (200, out.getvalue())
+    except multiprocessing.TimeoutError, e:
+        return (504, str(e))
+    except Exception, e:
+        return (422, "%s: %s" % (e.__class__.__name__, e))
+    finally:
+        if alarm:
+            signal.alarm(0)
+
+class LimitedReader(object):
+    """ A file-like object that reads at most size bytes from fp """
+
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.fp.read(size)
+        self.left -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        if size == 0:
+            return ""
+        data = self.fp.readline(size)
+        self.left -= len(data)
+        return data
+
+class Civ5RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Renders replays posted to /html or /csv as multipart form data, with the replay in a "replay" file field and an optional map in a "map" file field. "width" and "locale" can be given as form fields or query parameters. GET / returns a form to do this from a browser. """
+
+    form = """<html><body>
+<form action="/html" method="post" enctype="multipart/form-data">
+<p>Replay: <input type="file" name="replay"></p>
+<p>Map (optional): <input type="file" name="map"></p>
+<p>Width: <input type="text" name="width" value="1024"> Locale: <input type="text" name="locale" value="auto"></p>
+<p><input type="submit" value="Render"></p>
+</form>
+</body></html>
+"""
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path != "/":
+            self.send_error(404)
+            return
+        self.send_output(200, "text/html; charset=utf-8", self.form)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        format = url.path.strip("/")
+        if format not in ("html", "csv"):
+            self.send_error(404)
+            return
+        length = self.headers.getheader("content-length")
+        if length is None:
+            self.send_error(411)
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad Content-Length")
+            return
+        if length > self.server.max_upload:
+            self.send_error(413)
+            return
+        # the form is parsed up to boundaries in the body, so don't let it read past the upload
+        form = cgi.FieldStorage(fp=LimitedReader(self.rfile, length), headers=self.headers, environ={
+            "REQUEST_METHOD":   "POST",
+            "CONTENT_TYPE":     self.headers.getheader("content-type", ""),
+        })
+        query = urlparse.parse_qs(url.query)
+        replay_data = self.upload(form, "replay")
+        if replay_data is None:
+            self.send_error(400, "No replay file was uploaded")
+            return
+        map_data = self.upload(form, "map")
+        try:
+            width = int(form.getfirst("width") or query.get("width", [0])[0] or 0)
+        except ValueError:
+            self.send_error(400, "Bad width")
+            return
+        locale = form.getfirst("locale") or query.get("locale", [self.server.settings["locale"]])[0]
+        # every locale gets regexps compiled and kept for it, so only take known ones
+        if locale not in self.server.locales:
+            self.send_error(400, "Unknown locale")
+            return
+        code, output = self.server.render(replay_data, map_data, format, width, locale)
+        if code != 200:
+            if isinstance(output, unicode):
+                output = output.encode("utf-8")
+            self.send_output(code, "text/plain; charset=utf-8", output + "\n")
+            return
+        self.send_output(200, format == "csv" and "text/csv; charset=utf-8" or "text/html; charset=utf-8", output)
+
+    def upload(self, form, name):
+        """ Return the contents of the first file uploaded as field name, or None """
+        if name not in form:
+            return None
+        field = form[name]
+        if isinstance(field, list):
+            field = field[0]
+        if not field.file:
+            return None
+        return field.value
+
+    def send_output(self, code, content_type, output):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+class Civ5RenderService(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ An HTTP server that renders replays on a pool of warm worker processes, see Civ5RenderHandler. At most jobs replays are rendered at once and queue_size more wait for a worker, further requests are turned away with 503. Each job gets timeout seconds. The last cache_size bytes of output are kept in memory, so repeated uploads of a file are answered without rendering it again. """
+
+    daemon_threads = True
+    max_upload = 64*1024*1024
+    # seconds to wait for a job beyond its timeout, for when the worker's own alarm can't go off
+    job_grace = 5
+
+    def __init__(self, address, settings, jobs=4, queue_size=16, timeout=60, cache_size=64*1024*1024):
+        # start the workers before opening the socket so they don't inherit it
+        self.pool = multiprocessing.Pool(jobs)
+        BaseHTTPServer.HTTPServer.__init__(self, address, Civ5RenderHandler)
+        self.settings = settings
+        self.locales = event_messages.locales() | set(["auto", settings["locale"]])
+        self.job_timeout = timeout
+        self.slots = threading.BoundedSemaphore(jobs + queue_size)
+        self.results = collections.OrderedDict()
+        self.results_size = 0
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def render(self, replay_data, map_data, format, width, locale):
+        """ Render a replay, or return its output from the result cache. Returns an HTTP status code and the output or an error message. """
+        h = hashlib.sha1("%d %s %d %s %d\n" % (parser_version, format, width, locale, len(replay_data)))
+        h.update(replay_data)
+        h.update(map_data or "")
+        key = h.hexdigest()
+        with self.lock:
+            output = self.results.pop(key, None)
+            if output is not None:
+                self.results[key] = output
+                return (200, output)
+
+        if not self.slots.acquire(False):
+            return (503, "Too many replays waiting to be rendered")
+        try:
+            settings = dict(self.settings)
+            settings["locale"] = locale
+            settings["width"] = width or settings["width"]
+            settings["timeout"] = self.job_timeout
+            job = self.pool.apply_async(render_replay, ((replay_data, map_data, format, settings),))
+        except:
+            self.slots.release()
+            raise
+        try:
+            try:
+                code, output = job.get(self.job_timeout + self.job_grace)
+            finally:
+                # the slot is given back when the job is done, not when we stop waiting for it
+                if job.ready():
+                    self.slots.release()
+                else:
+                    reaper = threading.Thread(target=self.reap, args=(job,))
+                    reaper.daemon = True
+                    reaper.start()
+        except multiprocessing.TimeoutError:
+            return (504, "rendering took too long")
+        except Exception, e:
+            # e.g. the output couldn't be sent back from the worker
+            return (500, "%s: %s" % (e.__class__.__name__, e))
+
+        if code == 200 and len(output) <= self.cache_size:
+            with self.lock:
+                if key not in self.results:
+                    self.results[key] = output
+                    self.results_size += len(output)
+                while self.results_size > self.cache_size:
+                    old_key, old = self.results.popitem(last=False)
+                    self.results_size -= len(old)
+        return (code, output)
+
+    def reap(self, job):
+        """ Give back the slot of a job that timed out once it is done. A job whose worker died is never done, so the slot is given back after another timeout regardless. """
+        job.wait(self.job_timeout)
+        self.slots.release()
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
 # If run as a script, read the first file given on the command line
 # Some options exist, run with -h to see them
 if __name__ == "__main__":
@@ -1881,11 +3822,58 @@ if __name__ == "__main__":
     op.add_option("-w", "--width", 
         help="Make the HTML canvas WIDTH pixels wide", metavar="WIDTH")
     op.add_option("-H", "--html",
-        help="Write HTML output to FILE", metavar="FILE")
+        help="Write HTML output to FILE (a directory in batch mode)", metavar="FILE")
     op.add_option("-C", "--csv",
-        help="Write CSV output to FILE", metavar="FILE")
+        help="Write CSV output to FILE (a directory in batch mode)", metavar="FILE")
+    op.add_option("-F", "--frames",
+        help="Write the map as text after every turn to FILE", metavar="FILE")
+    op.add_option("-b", "--batch", action="store_true",
+        help="Convert all replay files, directories and glob patterns given; implied by more than one of them")
+    op.add_option("--catalogue",
+        help="Add the header data of all replay files, directories and glob patterns given to the SQLite database DB", metavar="DB")
+    op.add_option("-j", "--jobs", type="int", default=multiprocessing.cpu_count(),
+        help="Convert JOBS files at once in batch mode (default: %default)", metavar="JOBS")
+    op.add_option("--cache",
+        help="Keep parsed replays in directory DIR", metavar="DIR")
+    op.add_option("--cache-size", type="int", default=256,
+        help="Limit the cache directory to SIZE megabytes (default: %default)", metavar="SIZE")
+    op.add_option("--serve",
+        help="Render uploaded replays over HTTP on [HOST:]PORT", metavar="ADDRESS")
+    op.add_option("--queue", type="int", default=16,
+        help="Let up to QUEUE uploads wait for a worker when serving (default: %default)", metavar="QUEUE")
+    op.add_option("--timeout", type="int", default=60,
+        help="Give up on a replay after SECONDS when serving (default: %default)", metavar="SECONDS")
+    op.add_option("--result-cache", type="int", default=64,
+        help="Keep up to SIZE megabytes of output in memory when serving (default: %default)", metavar="SIZE")
+    op.add_option("--profile",
+        help="Write time spent and calls made per phase as JSON to FILE", metavar="FILE")
     (options, args) = op.parse_args()
 
+    if options.cache and os.path.exists(options.cache) and not os.path.isdir(options.cache):
+        op.error("--cache %s is not a directory" % (options.cache,))
+    if options.profile and (options.serve or options.catalogue):
+        op.error("--profile can't be used with --serve or --catalogue")
+
+    if options.serve:
+        host, port = "", options.serve
+        if ":" in port:
+            host, port = port.rsplit(":", 1)
+        settings = {
+            "locale": options.locale or locale,
+            "width": options.width and int(options.width),
+            "cache": options.cache,
+            "cache_size": options.cache_size*1024*1024,
+        }
+        server = Civ5RenderService((host, int(port)), settings, max(1, options.jobs),
+            options.queue, options.timeout, options.result_cache*1024*1024)
+        print "Serving on http://%s:%d/ with %d workers" % (host or "localhost", server.server_address[1], max(1, options.jobs))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        sys.exit(0)
+
     if len(args) == 0 and options.map is None:
         p("You need to tell me which replay file I should examine.")
         sys.exit(1)
@@ -1896,14 +3884,54 @@ if __name__ == "__main__":
     if options.debug:
         debug = True
 
+    profile = None
+    if options.profile:
+        profile = Civ5Profile()
+    context = Civ5Context(locale, debug, profile)
+
+    if options.catalogue:
+        start = time.time()
+        catalogue = Civ5Catalogue(options.catalogue)
+        changed, unchanged, removed, failed = catalogue.update(replay_files(args))
+        catalogue.close()
+        print "%s: %d new or changed, %d unchanged, %d removed, %d failed in %.1fs" % (
+            options.catalogue, changed, unchanged, removed, failed, time.time() - start)
+        sys.exit(failed > 0 and 1 or 0)
+
+    if options.batch or len(args) > 1 or (len(args) == 1 and (os.path.isdir(args[0]) or glob.has_magic(args[0]))):
+        files = replay_names(args)
+        for d in (options.html, options.csv):
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+        settings = {
+            "locale": locale,
+            "debug": debug,
+            "map": options.map,
+            "width": options.width and int(options.width),
+            "html": options.html,
+            "csv": options.csv,
+            "cache": options.cache,
+            "cache_size": options.cache_size*1024*1024,
+        }
+        failed = batch(files, settings, max(1, options.jobs), profile)
+        if profile is not None:
+            p("Writing profile to %s" % (options.profile,))
+            out = open(options.profile, "w")
+            profile.write(out)
+            out.close()
+        sys.exit(failed > 0 and 1 or 0)
+
     replay = None
     if len(args) > 0:
         p("Replaying: %s" % (args[0],))
         if not options.quiet:
             p("-" * 78 + "\n")
-        replay = Civ5Replay(args[0])
+        cache = None
+        if options.cache:
+            cache = Civ5ReplayCache(options.cache, options.cache_size*1024*1024)
+        replay = Civ5Replay(args[0], cache=cache, context=context)
         p("Leader:", replay.leader_info())
-        p("Victory type: %s" % (replay.victory_type))
+        p("Victory type: %s" % (replay.context.s(replay.victory_type)))
         p("Game options: %s; enabled victory types: %s" % (replay.get_game_options(), replay.get_enabled_victory_types()))
         if args[0].endswith(".Civ5Replay"):
             base = args[0].rsplit(".", 1)[0]
@@ -1920,7 +3948,7 @@ if __name__ == "__main__":
         replay.html_w = int(options.width);
 
     if options.map:
-        the_map = Civ5Map(options.map)
+        the_map = Civ5Map(options.map, context=context)
         p("Map:", the_map.map_info(), options.map)
         if replay:
             replay.set_background(the_map)
@@ -1930,13 +3958,24 @@ if __name__ == "__main__":
         sys.exit(0)
 
     # Read all events and print them
-    last_turn = -1
+    frames = None
+    if options.frames:
+        p("Writing map frames to %s" % (options.frames,))
+        frames = codecs.open(options.frames, "w", "utf-8")
+        map_text = Civ5MapText()
+        l_Turn = replay.context.s(replay.l_Turn)
+    last_turn = None
     while True:
-        last_map = replay.map_string()
         evt = replay.read_event()
-        if evt.turn != last_turn:
-            # p(last_map)
-            last_turn = evt.turn
+        if frames is not None:
+            # the map as of the end of a turn, once the next one starts
+            if last_turn is not None and evt.turn != last_turn:
+                frames.write(u"%s %d\n%s\n" % (l_Turn, last_turn, map_text.text()))
+            map_text.update(evt)
+            if evt.is_last_event():
+                frames.write(u"%s %d\n%s\n" % (l_Turn, evt.turn, map_text.text()))
+                frames.close()
+        last_turn = evt.turn
         if not options.quiet:
             if options.debug:
                 p(unicode(evt) + " [%d,%d]" % (evt.x, evt.y))
@@ -1950,8 +3989,8 @@ if __name__ == "__main__":
     # Export HTML
     if options.html:
         p("Writing HTML to %s" % (options.html,))
-        html = codecs.open(options.html, "w", "utf-8")
-        html.write(replay.html())
+        html = open(options.html, "wb")
+        replay.write_html(html)
         html.close()
     
     # Export histogram as CSV if requested
@@ -1961,3 +4000,10 @@ if __name__ == "__main__":
         csv.write(replay.csv())
         csv.close()
 
+    # Write the profile if requested
+    if profile is not None:
+        p("Writing profile to %s" % (options.profile,))
+        out = open(options.profile, "w")
+        profile.write(out)
+        out.close()
+
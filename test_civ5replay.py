@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+#
+# Tests for civ5replay.py, run with python -m unittest test_civ5replay
+# The replays are written by civ5bench.py.
+#
+
+import os
+import signal
+import socket
+import StringIO
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import civ5bench
+import civ5replay
+
+def write_fixture(directory, size_id=0, civs=4, turns=60):
+    """ Write a synthetic replay into directory and return its path """
+    path = os.path.join(directory, "%d_%d_%d.Civ5Replay" % (size_id, civs, turns))
+    civ5bench.write_replay(path, size_id, civs, turns)
+    return path
+
+def event_tuple(evt):
+    """ An event as a tuple that compares equal when the events do """
+    return (evt.turn, evt.event_type, evt.x, evt.y, evt.civ, unicode(evt))
+
+def read_events(replay):
+    """ Read all events of a replay with read_event(), see event_tuple() """
+    events = []
+    while True:
+        evt = replay.read_event()
+        events.append(event_tuple(evt))
+        if evt.is_last_event():
+            return events
+
+def new_context():
+    return civ5replay.Civ5Context("auto", False)
+
+def wait_for(condition, timeout=30):
+    """ Wait until condition() is true, failing if that takes longer than timeout seconds """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("gave up waiting")
+        time.sleep(0.05)
+
+render_replay = civ5replay.render_replay
+
+def block_render(job):
+    """ Stands in for render_replay() on a service worker. If settings["started"] is set, creates that file once the job has been picked up and never finishes. Workers started while this is patched in use it too, so otherwise it renders as usual. """
+    settings = job[3]
+    if "started" not in settings:
+        return render_replay(job)
+    open(settings["started"], "w").close()
+    time.sleep(3600)
+
+class ReplayCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="civ5test")
+        self.path = write_fixture(self.directory)
+        self.cache_dir = os.path.join(self.directory, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        cache = civ5replay.Civ5ReplayCache(self.cache_dir)
+        replay = civ5replay.Civ5Replay(self.path, cache=cache, context=new_context())
+        events = read_events(replay)
+        csv = replay.csv()
+        cached = civ5replay.Civ5Replay(self.path, cache=cache, context=new_context())
+        self.assertTrue(cached.fully_read)
+        self.assertEqual(read_events(cached), events)
+        self.assertEqual(cached.csv(), csv)
+
+    def test_failed_store_leaves_parsing_alone(self):
+        cache = civ5replay.Civ5ReplayCache(self.cache_dir)
+        shutil.rmtree(self.cache_dir)
+        replay = civ5replay.Civ5Replay(self.path, cache=cache, context=new_context())
+        self.assertEqual(read_events(replay), read_events(civ5replay.Civ5Replay(self.path, context=new_context())))
+
+class ReplayIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="civ5test")
+        self.path = write_fixture(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_turns(self):
+        events = read_events(civ5replay.Civ5Replay(self.path, context=new_context()))
+        civ5replay.replay_index(self.path, interval=10)
+        # from the sidecar file written by the first call
+        index = civ5replay.replay_index(self.path, interval=10)
+        final = events[-1][0]
+        for first, last in ((0, final), (0, 5), (10, 10), (17, 33), (final - 3, final)):
+            replay = civ5replay.Civ5Replay(self.path, context=new_context())
+            turns = [ event_tuple(evt) for evt in replay.read_turns(first, last, index) ]
+            self.assertEqual(turns, [ evt for evt in events if first <= evt[0] <= last ])
+
+class ReplayParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="civ5test")
+        f = open(write_fixture(self.directory), "rb")
+        self.data = f.read()
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parse(self, data, chunk_size):
+        """ Feed data to a Civ5ReplayParser chunk_size bytes at a time. Returns the parser and what it returned. """
+        parser = civ5replay.Civ5ReplayParser(new_context())
+        out = []
+        for i in range(0, len(data), chunk_size):
+            out.extend(parser.feed(data[i:i+chunk_size]))
+        out.extend(parser.close())
+        return parser, out
+
+    def test_chunk_sizes(self):
+        replay = civ5replay.Civ5Replay(StringIO.StringIO(self.data), context=new_context())
+        replay.read_full()
+        replay.id = "replay"
+        events = [ event_tuple(evt) for evt in replay.events ]
+        rows = list(replay.histogram.rows())
+        for chunk_size in (1, 7, 1000, len(self.data)):
+            parser, out = self.parse(self.data, chunk_size)
+            self.assertEqual([ kind for kind, value in out ], ["header"] + ["event"] * len(events) + ["histogram"])
+            self.assertEqual(out[0][1], replay.header_info())
+            self.assertEqual([ event_tuple(value) for kind, value in out[1:-1] ], events)
+            self.assertEqual(list(out[-1][1].rows()), rows)
+            parser.replay.id = replay.id
+            self.assertEqual(parser.replay.csv(), replay.csv())
+            self.assertEqual(parser.replay.html(), replay.html())
+
+    def test_truncated(self):
+        for size in (30, len(self.data) // 2, len(self.data) - 10):
+            data = self.data[:size]
+            try:
+                replay = civ5replay.Civ5Replay(StringIO.StringIO(data), context=new_context())
+                replay.read_full()
+                expected = [ event_tuple(evt) for evt in replay.events ]
+            except Exception, e:
+                expected = e.__class__
+            try:
+                parser, out = self.parse(data, 7)
+                result = [ event_tuple(value) for kind, value in out if kind == "event" ]
+            except Exception, e:
+                result = e.__class__
+            self.assertEqual(result, expected)
+
+class RenderServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="civ5test")
+        settings = { "locale": "en", "width": None, "cache": None, "cache_size": 0 }
+        self.server = civ5replay.Civ5RenderService(("127.0.0.1", 0), settings, jobs=1, queue_size=0, timeout=2)
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def replay_data(self, size_id, civs, turns):
+        path = os.path.join(self.directory, "%d_%d_%d.Civ5Replay" % (size_id, civs, turns))
+        civ5bench.write_replay(path, size_id, civs, turns)
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def post(self, headers, body=""):
+        """ Send a POST /csv request as it is given and return the response status """
+        sock = socket.create_connection(self.server.server_address)
+        try:
+            sock.sendall("POST /csv HTTP/1.0\r\n" + "".join([ "%s: %s\r\n" % h for h in headers ]) + "\r\n" + body)
+            response = sock.makefile("rb").read()
+        finally:
+            sock.close()
+        return int(response.split(" ", 2)[1])
+
+    def form(self, fields):
+        """ Return a multipart content type and body uploading fields, a list of (name, data) pairs """
+        boundary = "civ5testboundary"
+        body = "".join([ "--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\n\r\n%s\r\n" % (boundary, name, name, data) for name, data in fields ])
+        return "multipart/form-data; boundary=" + boundary, body + "--%s--\r\n" % (boundary,)
+
+    def test_upload_checks(self):
+        t = threading.Thread(target=self.server.serve_forever)
+        t.start()
+        try:
+            replay = self.replay_data(0, 2, 20)
+            content_type, body = self.form([("replay", replay), ("replay", replay)])
+            self.assertEqual(self.post([("Content-Type", content_type)], body), 411)
+            self.assertEqual(self.post([("Content-Type", content_type), ("Content-Length", "lots")], body), 400)
+            self.assertEqual(self.post([("Content-Type", content_type), ("Content-Length", "-1")], body), 400)
+            self.assertEqual(self.post([("Content-Type", content_type), ("Content-Length", str(len(body)))], body), 200)
+            # the form ends where Content-Length says, before the replay
+            self.assertEqual(self.post([("Content-Type", content_type), ("Content-Length", "40")], body), 400)
+        finally:
+            self.server.shutdown()
+            t.join()
+
+    def test_killed_worker_gives_back_its_slot(self):
+        self.server.job_timeout = 1
+        self.server.job_grace = 0
+        started = os.path.join(self.directory, "started")
+        self.server.settings["started"] = started
+        civ5replay.render_replay = block_render
+        try:
+            result = []
+            t = threading.Thread(target=lambda: result.append(self.server.render("lost", None, "csv", 0, "auto")))
+            t.start()
+            wait_for(lambda: os.path.exists(started))
+            for worker in self.server.pool._pool:
+                os.kill(worker.pid, signal.SIGKILL)
+            t.join()
+        finally:
+            civ5replay.render_replay = render_replay
+            del self.server.settings["started"]
+        self.assertEqual(result[0][0], 504)
+        # the slot comes back once the lost job has had another timeout to finish
+        fast = self.replay_data(0, 2, 20)
+        result = []
+        wait_for(lambda: result.append(self.server.render(fast, None, "csv", 0, "auto")) or result[-1][0] != 503)
+        self.assertEqual(result[-1][0], 200)
+
+if __name__ == "__main__":
+    unittest.main()